@@ -82,7 +82,7 @@ fluid_1_2 = fluid_1_2 || {};
     var deleteHandler = function (that, itemIndex) {
         if (that.options.serverOn) {
             $.ajax({
-                url: that.url + "/images/" + itemIndex,
+                url: that.url + "/images/" + that.model[itemIndex].id,
                 type: "DELETE"
             });
         }
@@ -160,6 +160,23 @@ fluid_1_2 = fluid_1_2 || {};
             });
     };
     
+    /**
+     * Returns the URL of one of the images of an entry. With the server, the
+     * image is fetched through /images/:id/:state next to the page, so that
+     * it is found from the capture page of a book (/books/:name/capture) too;
+     * the paths in the entries are relative to the root of the server.
+     * 
+     * @param {Object} that, the Capture component
+     * @param {Object} entry, an item of the model
+     * @param {String} state, "left", "right", "spread" or "thumb"
+     */
+    var imageUrl = function (that, entry, state) {
+        if (that.options.serverOn && entry.id !== undefined) {
+            return [that.url, "/images/", entry.id, "/", state].join('');
+        }
+        return entry[state];
+    };
+    
     /**
      * Renders the reorderable list of thumbnails. For each item in the model
      * adds the appropriate markup for it. An item in the rendered markup
@@ -192,7 +209,7 @@ fluid_1_2 = fluid_1_2 || {};
                         },
                         {
                             ID: "image",
-                            target: object.spread
+                            target: imageUrl(that, object, "spread")
                         },
                         {
                             ID: "deleteButton",
@@ -278,7 +295,7 @@ fluid_1_2 = fluid_1_2 || {};
                     
                     // TODO Use stitched image instead of left image
                     if (that.model.length !== 0) {
-                        imagePreview.attr("src", that.model[itemIndex].spread);
+                        imagePreview.attr("src", imageUrl(that, that.model[itemIndex], "spread"));
                     }
                     
                     updateElementStates(that);
@@ -292,15 +309,15 @@ fluid_1_2 = fluid_1_2 || {};
                     if (index !== oldIndex) {
                         that.model = reorderModel(that.model, index, oldIndex);
                         refreshIndices(that);
-                    }
 
-                    $.ajax({
-                        url: that.url + "/images/",
-                        type: "PUT",
-                        data: {
-                    	    images: JSON.stringify(that.model)
-                        }
-                    });
+                        $.ajax({
+                            url: that.url + "/images/",
+                            type: "PATCH",
+                            data: {
+                                patch: JSON.stringify([{op: "move", id: that.model[index].id, index: index}])
+                            }
+                        });
+                    }
 
                 }
             }
@@ -481,7 +498,7 @@ fluid_1_2 = fluid_1_2 || {};
             that.locate('itemIndex', clone).text(labelText.join(''));
             
             var image = that.locate("thumbImage", clone);
-            $(image).attr('src', newItem.thumb);
+            $(image).attr('src', imageUrl(that, newItem, "thumb"));
            
             that.locate("imageReorderer").append(clone);
             
@@ -575,6 +592,32 @@ fluid_1_2 = fluid_1_2 || {};
         });
     };
     
+    /**
+     * Listens to the events pushed by the server, so that thumbnails are shown
+     * as soon as they have been generated instead of after a reload. Does
+     * nothing in browsers without EventSource.
+     * 
+     * @param {Object} that, the Capture component
+     */
+    var listenForEvents = function (that) {
+        if (!window.EventSource) {
+            return;
+        }
+        
+        var source = new EventSource(that.url + "/events" + (that.lastEventId ? "?since=" + that.lastEventId : ""));
+        source.addEventListener("thumbnail-ready", function (event) {
+            var data = JSON.parse(event.data);
+            var i;
+            for (i = 0; i < that.model.length; i++) {
+                if (that.model[i].id === data.id) {
+                    // The thumbnail was requested before it existed; load it again.
+                    that.locate("thumbImage").eq(i).attr("src", imageUrl(that, that.model[i], "thumb") + "?v=" + event.lastEventId);
+                }
+            }
+        }, false);
+        that.eventSource = source;
+    };
+    
     /**
      * Creates a View for the Capture component. Contains an imageReorderer
      * subcomponent, a preview area for the image, and controls for capturing
@@ -593,7 +636,7 @@ fluid_1_2 = fluid_1_2 || {};
         
         // TODO Handle failure of getting the model.
         if (that.options.serverOn) {
-            $.ajax({
+            var request = $.ajax({
                 url: that.url + "/images/",
                 dataType: "json",
                 async: false,
@@ -601,6 +644,7 @@ fluid_1_2 = fluid_1_2 || {};
                     that.model = json_model;
                 }
             });
+            that.lastEventId = request.getResponseHeader("X-Last-Event-ID");
         } else {
             that.model = that.options.thumbs || [];
         }
@@ -616,6 +660,9 @@ fluid_1_2 = fluid_1_2 || {};
         
         initDialogs(that);
         bindHandlers(that);
+        if (that.options.serverOn) {
+            listenForEvents(that);
+        }
         
         if (that.model.length !== 0) {
             var thumbItems = that.locate("thumbItem");
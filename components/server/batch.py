@@ -0,0 +1,143 @@
+"""Module contains the batch capture sessions of the Decapod server.
+
+Scanning a book is a long series of identical captures. A batch session takes
+them one after the other without a request per spread: either on a timer (an
+interval of 0 capturing as fast as the cameras allow) or whenever it is
+triggered, by a foot pedal for example. Stitching and thumbnailing are left to
+the post-processing queue, so the cameras already capture the next spread while
+the previous one is processed; if that queue falls behind, the session waits
+for it, which keeps the backlog bounded.
+"""
+
+import sys
+import threading
+import time
+
+RUNNING = "running"
+STOPPED = "stopped"
+FINISHED = "finished"
+FAILED = "failed"
+
+class BatchSession(object):
+    """Captures a series of spreads in a background thread.
+
+    capture is called for every spread and returns its entry. count is the
+    number of spreads to capture, or None to go on until stopped. interval is
+    the time in seconds between the start of two captures, or None to capture
+    only when triggered. pending returns the number of spreads waiting for
+    post-processing; no capture starts while there are maxPending of them.
+    listener, if given, is called with the session after every capture and
+    when it ends."""
+
+    def __init__(self, id, capture, count=None, interval=None, pending=None, maxPending=4, listener=None):
+        self.id = id
+        self.capture = capture
+        self.count = count
+        self.interval = interval
+        self.pending = pending or (lambda: 0)
+        self.maxPending = maxPending
+        self.listener = listener
+        self.state = RUNNING
+        self.captured = 0
+        self.last = None
+        self.error = None
+        self.triggers = 0
+        self.stopping = False
+        self.condition = threading.Condition()
+        self.started = time.time()
+        self.ended = None
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def trigger(self):
+        """Asks for one more capture (in triggered sessions)."""
+        self.condition.acquire()
+        try:
+            self.triggers += 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def stop(self):
+        """Stops the session once the capture in progress, if any, is done."""
+        self.condition.acquire()
+        try:
+            self.stopping = True
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def wait(self, timeout=None):
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+    def run(self):
+        nextShot = time.time()
+        try:
+            while self.count is None or self.captured < self.count:
+                if not self.waitForShot(nextShot) or not self.waitForPostProcessing():
+                    break
+                if self.interval is not None:
+                    # Do not try to catch up with shots that were missed.
+                    nextShot = max(nextShot + self.interval, time.time())
+                entry = self.capture()
+                self.captured += 1
+                self.last = entry["id"]
+                self.changed()
+            if self.stopping:
+                self.state = STOPPED
+            else:
+                self.state = FINISHED
+        except:
+            self.error = str(sys.exc_info()[1])
+            self.state = FAILED
+        self.ended = time.time()
+        self.changed()
+
+    def waitForShot(self, nextShot):
+        """Waits for the next shot; returns False if the session was stopped."""
+        self.condition.acquire()
+        try:
+            while not self.stopping:
+                if self.interval is None:
+                    if self.triggers:
+                        self.triggers -= 1
+                        return True
+                    self.condition.wait(1)
+                else:
+                    delay = nextShot - time.time()
+                    if delay <= 0:
+                        return True
+                    self.condition.wait(delay)
+            return False
+        finally:
+            self.condition.release()
+
+    def waitForPostProcessing(self):
+        """Waits while too many spreads wait for post-processing."""
+        self.condition.acquire()
+        try:
+            while not self.stopping and self.pending() >= self.maxPending:
+                self.condition.wait(0.05)
+            return not self.stopping
+        finally:
+            self.condition.release()
+
+    def changed(self):
+        if self.listener:
+            self.listener(self)
+
+    def status(self):
+        """Returns a JSON serializable description of the session."""
+        elapsed = (self.ended or time.time()) - self.started
+        spreadsPerMinute = elapsed and self.captured * 60.0 / elapsed or 0.0
+        status = {"id": self.id, "state": self.state, "count": self.count, "interval": self.interval,
+                  "captured": self.captured, "last": self.last, "seconds": elapsed,
+                  "spreadsPerMinute": spreadsPerMinute, "pagesPerMinute": 2 * spreadsPerMinute}
+        if self.error is not None:
+            status["error"] = self.error
+        return status
@@ -0,0 +1,299 @@
+"""Benchmark harness for the Decapod server.
+
+Runs the server in-process, with the stand-in tools of testData/bin in place of
+the cameras (gphoto2), decapod-stitching, ImageMagick and the PDF tools, each
+with a configurable delay. The stand-in gphoto2 copies its images from
+testData/imageFeed; --cameras selects one of the in-process camera backends
+instead ("feed" or "synthetic", as in the mock server). --camera-connect-delay
+is the time the stand-in takes to open a camera, which the gphoto2 backend pays
+once per camera with its shell sessions, or on every shot with
+--camera-sessions off. Every request goes
+through the real code of dserver.py. The harness drives a set of workloads over
+HTTP:
+
+    capture  POST /images/ (and waits for stitching and thumbnails)
+    batch    POST /images/batch/ capturing --captures spreads in one session
+    list     GET /images/
+    page     GET /images/?offset=...&limit=...&fields=id,thumb
+    fetch    GET /images/:id/spread
+    preview  GET /images/:id/spread?w=200
+    reorder  PATCH /images/ moving one page
+    export   POST /pdf/ and poll /pdf/:id/ until the PDF is done
+
+Run it from the components/server directory, for example:
+
+    python benchmarks/harness.py --book-size 1000 --concurrency 8 --camera-delay 0.5
+
+The results are printed (or written to --output) as JSON, so that runs can be
+compared across changes.
+"""
+
+import optparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import urllib
+import urllib2
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, serverPath)
+
+import cherrypy
+import simplejson as json
+
+import dserver
+
+stubPath = os.path.join(serverPath, "testData", "bin")
+feedPath = os.path.join(serverPath, "testData", "imageFeed")
+allWorkloads = ("capture", "batch", "list", "page", "fetch", "preview", "reorder", "export")
+
+class Client(object):
+    """A minimal HTTP client for the server under test."""
+
+    def __init__(self, port):
+        self.base = "http://127.0.0.1:%d" % port
+
+    def request(self, method, path, data=None, headers={}):
+        if isinstance(data, dict):
+            data = urllib.urlencode(data)
+        request = urllib2.Request(self.base + path, data, headers)
+        request.get_method = lambda: method
+        response = urllib2.urlopen(request)
+        try:
+            return response.read()
+        finally:
+            response.close()
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def drive(function, count, concurrency):
+    """Calls function(i) for i in range(count) from concurrency threads.
+
+    Returns the throughput, error count and latency distribution."""
+    timings = []
+    errors = []
+    counter = iter(range(count))
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            lock.acquire()
+            try:
+                i = next(counter, None)
+            finally:
+                lock.release()
+            if i is None:
+                return
+            start = time.time()
+            try:
+                function(i)
+                timings.append(time.time() - start)
+            except Exception as e:
+                errors.append(str(e))
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    timings.sort()
+    result = {"requests": count, "errors": len(errors), "seconds": elapsed,
+              "throughput": len(timings) / elapsed if elapsed else None,
+              "latency": {"mean": timings and sum(timings) / len(timings) or None,
+                          "p50": percentile(timings, 0.5), "p90": percentile(timings, 0.9),
+                          "p99": percentile(timings, 0.99), "max": timings and timings[-1] or None}}
+    if errors:
+        result["firstError"] = errors[0]
+    return result
+
+class Harness(object):
+    """Runs the server under test and the workloads against it."""
+
+    def __init__(self, options):
+        self.options = options
+        self.workDir = tempfile.mkdtemp(prefix="decapod-bench-")
+        self.client = Client(options.port)
+
+    def configure(self):
+        options = self.options
+        os.environ["PATH"] = stubPath + os.pathsep + os.environ.get("PATH", "")
+        os.environ["FAKE_GPHOTO2_DELAY"] = str(options.camera_delay)
+        os.environ["FAKE_GPHOTO2_CONNECT_DELAY"] = str(options.camera_connect_delay)
+        os.environ["FAKE_STITCH_DELAY"] = str(options.stitch_delay)
+        os.environ["FAKE_CONVERT_DELAY"] = str(options.convert_delay)
+        os.environ["FAKE_TIFFCP_PAGE_DELAY"] = str(options.tiffcp_delay)
+        os.environ["FAKE_GENPDF_DELAY"] = str(options.genpdf_delay)
+
+        dserver.imagePath = os.path.join(self.workDir, "capturedImages")
+        dserver.cataloguePath = os.path.join(self.workDir, "catalogue.sqlite")
+        dserver.derivativePath = os.path.join(self.workDir, "derivatives")
+        dserver.workspacePath = os.path.join(self.workDir, "books")
+        dserver.Export.exportPdfPath = os.path.join(self.workDir, "pdf")
+        dserver.stitchingBackend = options.stitching
+        dserver.exportBackend = options.export_backend
+
+    def start(self):
+        self.configure()
+        cameraOptions = {}
+        if self.options.cameras == "gphoto2":
+            cameraOptions["sessions"] = self.options.camera_sessions == "on"
+        root = dserver.createServer(self.options.cameras, **cameraOptions)
+        self.images = root.images
+
+        cherrypy.config.update({"server.socket_port": self.options.port,
+                                "server.thread_pool": self.options.concurrency + 4,
+                                "log.screen": False, "checker.on": False,
+                                "engine.autoreload.on": False})
+        cherrypy.tree.mount(root, "/", {"/": {"tools.timing.on": True}})
+        cherrypy.engine.start()
+
+    def stop(self):
+        cherrypy.engine.exit()
+        shutil.rmtree(self.workDir, True)
+
+    def fillBook(self, size):
+        """Adds size spreads to the catalogue without going through the cameras."""
+        feed = [os.path.join(feedPath, name) for name in sorted(os.listdir(feedPath))]
+        thumb = os.path.join(self.workDir, "thumb.jpg")
+        self.images.generateThumbnail(feed[0])
+        shutil.move(self.images.thumbnailPath(feed[0]), thumb)
+
+        operations = []
+        for i in range(size):
+            left, right = feed[(2 * i) % len(feed)], feed[(2 * i + 1) % len(feed)]
+            operations.append({"op": "insert", "entry": {"left": left, "right": right, "spread": left, "thumb": thumb}})
+        self.images.images.patch(operations)
+
+    def ids(self):
+        return [entry["id"] for entry in self.images.images.list()]
+
+    def waitForPostProcessing(self):
+        for job in list(self.images.jobs.values()):
+            job.wait()
+
+    def capture(self):
+        start = time.time()
+        result = drive(lambda i: self.client.request("POST", "/images/", ""),
+                       self.options.captures, self.options.concurrency)
+        self.waitForPostProcessing()
+        result["secondsUntilProcessed"] = time.time() - start
+        result["spreadsPerMinute"] = self.options.captures * 60 / result["secondsUntilProcessed"]
+        return result
+
+    def batch(self):
+        start = time.time()
+        status = json.loads(self.client.request("POST", "/images/batch/",
+                                                {"count": self.options.captures, "interval": 0}))
+        while status["state"] == "running":
+            time.sleep(0.05)
+            status = json.loads(self.client.request("GET", "/images/batch/%d/" % status["id"]))
+        if status["state"] != "finished":
+            raise Exception(status.get("error", "Batch capture %s" % status["state"]))
+        self.waitForPostProcessing()
+        result = {"captured": status["captured"], "secondsCapturing": status["seconds"],
+                  "secondsUntilProcessed": time.time() - start}
+        result["spreadsPerMinute"] = status["captured"] * 60 / result["secondsUntilProcessed"]
+        result["pagesPerMinute"] = 2 * result["spreadsPerMinute"]
+        return result
+
+    def list(self):
+        return drive(lambda i: self.client.request("GET", "/images/"),
+                     self.options.requests, self.options.concurrency)
+
+    def page(self):
+        size = len(self.images.images)
+        def fetchPage(i):
+            offset = random.randrange(max(1, size - 20))
+            self.client.request("GET", "/images/?offset=%d&limit=20&fields=id,thumb" % offset)
+        return drive(fetchPage, self.options.requests, self.options.concurrency)
+
+    def fetch(self, query=""):
+        ids = self.ids()
+        return drive(lambda i: self.client.request("GET", "/images/%d/spread%s" % (random.choice(ids), query)),
+                     self.options.requests, self.options.concurrency)
+
+    def preview(self):
+        return self.fetch("?w=200")
+
+    def reorder(self):
+        ids = self.ids()
+        def move(i):
+            patch = [{"op": "move", "id": random.choice(ids), "index": random.randrange(len(ids))}]
+            self.client.request("PATCH", "/images/", {"patch": json.dumps(patch)})
+        return drive(move, self.options.requests, self.options.concurrency)
+
+    def export(self):
+        images = json.dumps(self.images.images.list()[:self.options.export_pages])
+        def exportBook(i):
+            status = json.loads(self.client.request("POST", "/pdf/", {"images": images}))
+            while status["state"] in ("pending", "running"):
+                time.sleep(0.05)
+                status = json.loads(self.client.request("GET", "/pdf/%s/" % status["id"]))
+            if status["state"] != "done":
+                raise Exception(status.get("error", "Export failed"))
+            self.client.request("GET", status["pdf"])
+        return drive(exportBook, self.options.exports, self.options.concurrency)
+
+    def run(self):
+        self.start()
+        try:
+            self.fillBook(self.options.book_size)
+            results = {}
+            for workload in self.options.workloads.split(","):
+                if not workload in allWorkloads:
+                    raise ValueError("Unknown workload %s" % workload)
+                results[workload] = getattr(self, workload)()
+            return results
+        finally:
+            self.stop()
+
+def main():
+    parser = optparse.OptionParser(usage="%prog [options]")
+    parser.add_option("--workloads", default=",".join(allWorkloads),
+                      help="comma separated workloads to run [%default]")
+    parser.add_option("--book-size", type="int", default=200, help="spreads in the book [%default]")
+    parser.add_option("--concurrency", type="int", default=4, help="concurrent clients [%default]")
+    parser.add_option("--requests", type="int", default=200, help="requests per read workload [%default]")
+    parser.add_option("--captures", type="int", default=10, help="spreads captured [%default]")
+    parser.add_option("--exports", type="int", default=2, help="exports run [%default]")
+    parser.add_option("--export-pages", type="int", default=20, help="spreads per export [%default]")
+    parser.add_option("--camera-delay", type="float", default=0.0, help="seconds per shot of the stand-in gphoto2 [%default]")
+    parser.add_option("--camera-connect-delay", type="float", default=0.0,
+                      help="seconds the stand-in gphoto2 takes to open a camera [%default]")
+    parser.add_option("--camera-sessions", default="on",
+                      help="keep a gphoto2 shell open per camera: on or off [%default]")
+    parser.add_option("--stitch-delay", type="float", default=0.0, help="seconds per stitch [%default]")
+    parser.add_option("--convert-delay", type="float", default=0.0, help="seconds per page conversion [%default]")
+    parser.add_option("--tiffcp-delay", type="float", default=0.0, help="seconds per page combined [%default]")
+    parser.add_option("--genpdf-delay", type="float", default=0.0, help="seconds per PDF generation [%default]")
+    parser.add_option("--cameras", default="gphoto2", help="camera backend: gphoto2, feed or synthetic [%default]")
+    parser.add_option("--stitching", default="decapod", help="stitching backend: decapod or pil [%default]")
+    parser.add_option("--export-backend", default="stream", help="export backend: stream or decapod [%default]")
+    parser.add_option("--port", type="int", default=8090)
+    parser.add_option("--output", help="write the results to this file instead of stdout")
+    options, args = parser.parse_args()
+
+    harness = Harness(options)
+    report = {"started": time.strftime("%Y-%m-%dT%H:%M:%S"), "options": options.__dict__,
+              "results": harness.run()}
+
+    output = json.dumps(report, indent=2, sort_keys=True) + "\n"
+    if options.output:
+        file = open(options.output, "w")
+        file.write(output)
+        file.close()
+    else:
+        sys.stdout.write(output)
+
+if __name__ == "__main__":
+    main()
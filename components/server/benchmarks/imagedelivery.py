@@ -0,0 +1,136 @@
+"""Benchmark for the delivery of images on /images/:id/:state.
+
+Compares the streaming implementation of ImageController with the previous one,
+which read the whole file into memory and returned it as a single string. Each
+implementation runs in its own process (so peak memory use can be compared),
+serving a large generated PNG spread to several concurrent clients.
+
+Run it from the components/server directory:
+
+    python benchmarks/imagedelivery.py [--requests N] [--clients N] [--size WxH]
+
+Prints a JSON document with the throughput and the peak memory use of both.
+"""
+
+import optparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib2
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cherrypy
+import simplejson as json
+from PIL import Image
+
+import dserver
+from workspaces import Workspace
+
+class ReadingImageController(dserver.ImageController):
+    """ImageController serving images the way it did before streaming."""
+
+    def serveImage(self, path):
+        cherrypy.response.headers["Content-type"] = "image/jpeg"
+        try:
+            file = open(path)
+        except IOError:
+            raise cherrypy.HTTPError(404, "Image path can not be opened")
+
+        content = file.read()
+        file.close()
+        return content
+
+def makeImage(path, size):
+    """Writes a noisy PNG of the given size, which does not compress well."""
+    Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(path)
+
+def serve(mode, path, port):
+    workspace = Workspace("benchmark", tempfile.mkdtemp(), cataloguePath=":memory:")
+    workspace.catalogue.append({"left": path, "right": path, "spread": path, "thumb": path})
+    if mode == "streaming":
+        controller = dserver.ImageController(workspace)
+    else:
+        controller = ReadingImageController(workspace)
+
+    cherrypy.config.update({"server.socket_port": port, "server.thread_pool": 10,
+                            "log.screen": False, "engine.autoreload.on": False,
+                            "checker.on": False})
+    cherrypy.tree.mount(controller, "/images")
+    cherrypy.engine.start()
+
+def fetch(url, count, timings):
+    for i in range(count):
+        start = time.time()
+        response = urllib2.urlopen(url)
+        while response.read(1 << 16):
+            pass
+        response.close()
+        timings.append(time.time() - start)
+
+def run(mode, path, port, requests, clients):
+    """Runs one implementation and returns its measurements."""
+    serve(mode, path, port)
+    url = "http://127.0.0.1:%d/images/1/spread" % port
+    try:
+        timings = []
+        threads = [threading.Thread(target=fetch, args=(url, requests // clients, timings))
+                   for i in range(clients)]
+        start = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start
+    finally:
+        cherrypy.engine.exit()
+
+    timings.sort()
+    size = os.path.getsize(path)
+    return {"mode": mode, "requests": len(timings), "clients": clients, "fileSize": size,
+            "seconds": elapsed, "requestsPerSecond": len(timings) / elapsed,
+            "megabytesPerSecond": len(timings) * size / elapsed / (1 << 20),
+            "medianLatency": timings[len(timings) // 2],
+            "peakMemoryKB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--requests", type="int", default=200)
+    parser.add_option("--clients", type="int", default=8)
+    parser.add_option("--size", default="6000x4000")
+    parser.add_option("--port", type="int", default=8089)
+    parser.add_option("--mode", help="run a single implementation: streaming or reading")
+    parser.add_option("--image", help="image to serve instead of a generated one")
+    options, args = parser.parse_args()
+
+    if options.mode:
+        result = run(options.mode, options.image, options.port, options.requests, options.clients)
+        sys.stdout.write(json.dumps(result) + "\n")
+        return
+
+    image = options.image
+    if not image:
+        image = os.path.join(tempfile.mkdtemp(), "spread.png")
+        makeImage(image, tuple([int(n) for n in options.size.split("x")]))
+
+    results = []
+    try:
+        for mode in ("reading", "streaming"):
+            command = [sys.executable, os.path.abspath(__file__), "--mode", mode, "--image", image,
+                       "--requests", str(options.requests), "--clients", str(options.clients),
+                       "--port", str(options.port)]
+            output = subprocess.Popen(command, stdout=subprocess.PIPE).communicate()[0]
+            results.append(json.loads(output))
+    finally:
+        if not options.image:
+            os.unlink(image)
+            os.rmdir(os.path.dirname(image))
+
+    sys.stdout.write(json.dumps(results, indent=2) + "\n")
+
+if __name__ == "__main__":
+    main()
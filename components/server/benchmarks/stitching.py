@@ -0,0 +1,77 @@
+"""Benchmark for the stitching backends.
+
+Stitches pairs of images from testData/imageFeed with the decapod-stitching
+tool (if it is installed) and with the in-process backend in each of its output
+formats, and reports the time per spread and the size of the result.
+
+Run it from the components/server directory:
+
+    python benchmarks/stitching.py [--repeat N] [--feed DIRECTORY]
+
+Prints a JSON document with one result per backend and format.
+"""
+
+import glob
+import optparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import simplejson as json
+
+from stitching import StitchingError, SubprocessStitcher, ImageStitcher
+
+def configurations():
+    yield "decapod", SubprocessStitcher()
+    yield "pil-png", ImageStitcher("png", compressLevel=1)
+    yield "pil-png-6", ImageStitcher("png", compressLevel=6)
+    yield "pil-jpeg", ImageStitcher("jpeg", quality=90)
+    yield "pil-webp", ImageStitcher("webp", quality=90)
+
+def run(name, stitcher, pairs, repeat, output):
+    timings = []
+    sizes = []
+    for i in range(repeat):
+        for number, (left, right) in enumerate(pairs):
+            path = os.path.join(output, "%s-%d.%s" % (name, number, stitcher.extension))
+            start = time.time()
+            stitcher.stitch(left, right, path)
+            timings.append(time.time() - start)
+            sizes.append(os.path.getsize(path))
+    timings.sort()
+    return {"backend": name, "spreads": len(timings),
+            "meanSeconds": sum(timings) / len(timings),
+            "medianSeconds": timings[len(timings) // 2],
+            "meanBytes": sum(sizes) // len(sizes)}
+
+def main():
+    parser = optparse.OptionParser()
+    parser.add_option("--repeat", type="int", default=3)
+    parser.add_option("--feed", default="testData/imageFeed")
+    options, args = parser.parse_args()
+
+    images = glob.glob(os.path.join(options.feed, "*.jpg"))
+    images.sort()
+    pairs = zip(images[0::2], images[1::2])
+    if not pairs:
+        parser.error("%s needs at least two images" % options.feed)
+
+    output = tempfile.mkdtemp()
+    results = []
+    try:
+        for name, stitcher in configurations():
+            try:
+                results.append(run(name, stitcher, pairs, options.repeat, output))
+            except (StitchingError, IOError, KeyError) as e:
+                results.append({"backend": name, "error": str(e)})
+    finally:
+        shutil.rmtree(output, True)
+
+    sys.stdout.write(json.dumps(results, indent=2) + "\n")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,611 @@
+"""Module contains the camera registry and the camera backends of the Decapod server.
+
+Detecting cameras with gphoto2 takes seconds, so the registry probes them in
+the background and answers from memory. Each camera's capabilities are read
+from a single "gphoto2 --summary" call, parsed in-process, and remembered for
+as long as the camera stays connected.
+
+The server captures through a camera backend, which lists the cameras and
+captures an image with one of them into a file. Besides gphoto2 there are two
+backends for running the server without cameras: one copying images from a
+feed directory and one generating synthetic pages in memory.
+
+Starting gphoto2 for every shot means enumerating the USB bus, opening the
+camera and setting up a PTP session each time. The gphoto2 backend therefore
+keeps a "gphoto2 --shell" process open per camera (see SessionManager) and
+sends it a command per capture, checking idle sessions and reopening the ones
+which fail.
+"""
+
+import errno
+import glob
+import os
+import random
+import re
+import select
+import shutil
+import subprocess
+import tempfile
+import threading
+import time
+from cStringIO import StringIO
+
+from PIL import Image, ImageDraw
+
+import runner
+
+# The cameras the backends without real cameras pretend are connected.
+simulatedCameras = [{"model": "Canon Powershot SX110IS", "port": "usb:002,012", "capture": True, "download": True},
+                    {"model": "Nikon D80", "port": "usb:003,004", "capture": True, "download": True}]
+
+class CaptureError(Exception):
+    """Raised when a camera could not capture an image."""
+    pass
+
+class SessionError(CaptureError):
+    """Raised when the gphoto2 shell of a camera stopped answering."""
+    pass
+
+def gphoto2(*args):
+    """Runs gphoto2 with the given arguments and returns (status, output)."""
+    result = runner.run(["gphoto2"] + list(args), check=False)
+    return result.status, result.stdout
+
+def parseAutoDetect(output):
+    """Returns the (model, port) pairs listed by "gphoto2 --auto-detect"."""
+    found = []
+    for line in output.splitlines():
+        if line.startswith("Model") or line.startswith("-"):
+            continue
+        info = line.split()
+        if len(info) < 2:
+            continue
+        port = info.pop()
+        if port.endswith(":"):
+            continue
+        found.append((" ".join(info), port))
+    return found
+
+def parseSummary(output):
+    """Returns the (capture, download) capabilities from "gphoto2 --summary"."""
+    capture = "Generic Image Capture" in output
+    download = not "No File Download" in output
+    return capture, download
+
+class CameraRegistry(object):
+    """A thread-safe, cached list of the cameras attached to the PC.
+
+    The list is probed on first use and then refreshed in the background once
+    it is older than ttl seconds; callers always get the last known list
+    without waiting for gphoto2."""
+
+    def __init__(self, ttl=30):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Held while gphoto2 probes the cameras, so only one probe runs at a time.
+        self.probing = threading.Lock()
+        self.found = None
+        self.updated = 0
+        self.refreshing = False
+        self.capabilities = {}
+
+    def cameras(self):
+        """Returns a copy of the list of detected cameras.
+
+        Each camera is a dict with its model, port, capture and download
+        support."""
+        self.lock.acquire()
+        try:
+            found = self.found
+            stale = time.time() - self.updated > self.ttl
+        finally:
+            self.lock.release()
+
+        if found is None:
+            found = self.firstList()
+        elif stale:
+            self.refreshInBackground()
+        return [dict(camera) for camera in found]
+
+    def firstList(self):
+        """Probes the cameras unless it has been done, and returns the list.
+
+        Callers arriving while the first probe runs wait for its result rather
+        than running one of their own."""
+        self.probing.acquire()
+        try:
+            self.lock.acquire()
+            try:
+                found = self.found
+            finally:
+                self.lock.release()
+            if found is None:
+                found = self.detect()
+            return found
+        finally:
+            self.probing.release()
+
+    def refreshInBackground(self):
+        self.lock.acquire()
+        try:
+            if self.refreshing:
+                return
+            self.refreshing = True
+        finally:
+            self.lock.release()
+
+        thread = threading.Thread(target=self.backgroundRefresh)
+        thread.setDaemon(True)
+        thread.start()
+
+    def backgroundRefresh(self):
+        try:
+            self.refresh()
+        finally:
+            self.lock.acquire()
+            try:
+                self.refreshing = False
+            finally:
+                self.lock.release()
+
+    def refresh(self):
+        """Probes the attached cameras and returns the new list."""
+        self.probing.acquire()
+        try:
+            return self.detect()
+        finally:
+            self.probing.release()
+
+    def detect(self):
+        """Runs the probe; must be called with self.probing held."""
+        status, output = gphoto2("--auto-detect")
+        found = []
+        if status == 0:
+            detected = parseAutoDetect(output)
+            # Forget cameras which were disconnected.
+            self.lock.acquire()
+            try:
+                for key in list(self.capabilities.keys()):
+                    if not key in detected:
+                        del self.capabilities[key]
+            finally:
+                self.lock.release()
+            for model, port in detected:
+                capture, download = self.probe(model, port)
+                found.append({"model": model, "port": port, "capture": capture, "download": download})
+
+        self.lock.acquire()
+        try:
+            self.found = found
+            self.updated = time.time()
+        finally:
+            self.lock.release()
+        return found
+
+    def probe(self, model, port):
+        """Returns the capabilities of a camera, asking gphoto2 only once."""
+        key = (model, port)
+        self.lock.acquire()
+        try:
+            known = self.capabilities.get(key)
+        finally:
+            self.lock.release()
+        if known is not None:
+            return known
+
+        status, output = gphoto2("--summary", "--camera=%s" % model, "--port=%s" % port)
+        if status != 0:
+            # Do not remember failures, the camera may still be starting.
+            return False, False
+        capabilities = parseSummary(output)
+        self.lock.acquire()
+        try:
+            self.capabilities[key] = capabilities
+        finally:
+            self.lock.release()
+        return capabilities
+
+# The prompt gphoto2 --shell prints when it waits for a command: the local
+# directory in braces, then the folder on the camera.
+shellPrompt = re.compile(r"gphoto2: \{[^\n]*\} [^\n]*> $")
+savedFile = re.compile(r"^Saving file as (.+?)\s*$", re.M)
+
+class CameraSession(object):
+    """A gphoto2 shell kept open on one camera.
+
+    Captured images are downloaded into downloadPath, then moved to where
+    they were asked for. A command which gets no prompt back within timeout
+    seconds, or a shell which exits, raise SessionError; the session is closed
+    then, and has to be opened again."""
+
+    def __init__(self, model, port, downloadPath, timeout=60):
+        self.model = model
+        self.port = port
+        self.downloadPath = downloadPath
+        self.timeout = timeout
+        self.process = None
+        self.lastUsed = 0
+        self.captures = 0
+
+    def open(self):
+        try:
+            self.process = subprocess.Popen(["gphoto2", "--camera=%s" % self.model, "--port=%s" % self.port,
+                                             "--force-overwrite", "--shell"], cwd=self.downloadPath,
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                            stderr=subprocess.STDOUT, close_fds=True)
+        except OSError as e:
+            self.process = None
+            raise SessionError("Could not start gphoto2 for %s on %s: %s" % (self.model, self.port, e))
+        self.read()
+        self.lastUsed = time.time()
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+    def command(self, line):
+        """Sends a command to the shell and returns its output."""
+        if not self.alive():
+            self.close()
+            raise SessionError("The gphoto2 shell of %s on %s is not running." % (self.model, self.port))
+        try:
+            self.process.stdin.write(line + "\n")
+            self.process.stdin.flush()
+        except (IOError, OSError) as e:
+            self.close()
+            raise SessionError("Could not talk to gphoto2 for %s on %s: %s" % (self.model, self.port, e))
+        output = self.read()
+        self.lastUsed = time.time()
+        return output
+
+    def read(self):
+        """Returns the output of the shell up to its next prompt."""
+        deadline = time.time() + self.timeout
+        fd = self.process.stdout.fileno()
+        output = ""
+        while not shellPrompt.search(output):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.close()
+                raise SessionError("gphoto2 for %s on %s did not answer in %s seconds." % (self.model, self.port, self.timeout))
+            try:
+                ready = select.select([fd], [], [], remaining)[0]
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not ready:
+                continue
+            chunk = os.read(fd, 4096)
+            if not chunk:
+                self.close()
+                raise SessionError("gphoto2 for %s on %s exited: %s" % (self.model, self.port, output.strip()[-500:]))
+            output += chunk
+        return shellPrompt.sub("", output)
+
+    def capture(self, filename):
+        """Captures an image and moves it to filename."""
+        output = self.command("capture-image-and-download")
+        saved = savedFile.findall(output)
+        if not saved or "*** Error" in output:
+            raise CaptureError("Camera %s on %s could not capture: %s" % (self.model, self.port, output.strip()))
+        try:
+            shutil.move(os.path.join(self.downloadPath, saved[-1]), filename)
+        except (IOError, OSError) as e:
+            raise CaptureError("Could not move the image of %s on %s: %s" % (self.model, self.port, e))
+        self.captures += 1
+
+    def check(self):
+        """Asks the camera for its summary; raises SessionError if it does not answer."""
+        output = self.command("summary")
+        if not "Model" in output:
+            self.close()
+            raise SessionError("Camera %s on %s does not answer: %s" % (self.model, self.port, output.strip()))
+
+    def close(self):
+        process, self.process = self.process, None
+        if process is None:
+            return
+        try:
+            if process.poll() is None:
+                process.stdin.write("exit\n")
+                process.stdin.close()
+                # Give it a moment to release the camera properly.
+                for i in range(20):
+                    if process.poll() is not None:
+                        break
+                    time.sleep(0.05)
+        except (IOError, OSError):
+            pass
+        if process.poll() is None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.wait()
+        process.stdout.close()
+
+    def status(self):
+        return {"model": self.model, "port": self.port, "connected": self.alive(),
+                "captures": self.captures, "lastUsed": self.lastUsed}
+
+class SessionManager(object):
+    """Keeps a gphoto2 session open on each camera and reuses it for captures.
+
+    A session idle for more than healthInterval seconds is checked before its
+    next capture, and in the background so a camera which was switched off is
+    noticed before it is needed. A session which fails is reopened and the
+    capture tried again, up to retries times. The captures, reconnects and
+    failed health checks are counted by port, for the server metrics.
+
+    Without a downloadPath, images are downloaded into a temporary directory
+    which is removed by close()."""
+
+    def __init__(self, downloadPath=None, timeout=60, healthInterval=30, retries=1):
+        self.temporary = downloadPath is None
+        self.downloadPath = downloadPath or tempfile.mkdtemp(prefix="decapod-gphoto2-")
+        self.timeout = timeout
+        self.healthInterval = healthInterval
+        self.retries = retries
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.portLocks = {}
+        self.captures = {}
+        self.reconnects = {}
+        self.checkFailures = {}
+        self.monitor = None
+
+    def count(self, counter, port):
+        self.lock.acquire()
+        try:
+            counter[port] = counter.get(port, 0) + 1
+        finally:
+            self.lock.release()
+
+    def counts(self, counter):
+        """Returns a copy of one of the counters, by port."""
+        self.lock.acquire()
+        try:
+            return dict(counter)
+        finally:
+            self.lock.release()
+
+    def portLock(self, port):
+        self.lock.acquire()
+        try:
+            return self.portLocks.setdefault(port, threading.Lock())
+        finally:
+            self.lock.release()
+
+    def session(self, model, port):
+        """Returns the open session of a camera, opening it if needed.
+
+        Must be called with the lock of the port held."""
+        session = self.sessions.get(port)
+        if session is not None and (session.model != model or not session.alive()):
+            session.close()
+            session = None
+        if session is None:
+            directory = os.path.join(self.downloadPath, re.sub(r"[^A-Za-z0-9]", "_", port))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            session = CameraSession(model, port, directory, self.timeout)
+            session.open()
+            self.sessions[port] = session
+            self.startMonitor()
+        elif time.time() - session.lastUsed > self.healthInterval:
+            self.check(session)
+        return session
+
+    def check(self, session):
+        try:
+            session.check()
+        except SessionError:
+            self.count(self.checkFailures, session.port)
+            raise
+
+    def capture(self, port, model, filename):
+        """Captures an image with a camera and downloads it to filename."""
+        portLock = self.portLock(port)
+        portLock.acquire()
+        try:
+            for attempt in range(self.retries + 1):
+                try:
+                    self.session(model, port).capture(filename)
+                    self.count(self.captures, port)
+                    return
+                except SessionError:
+                    if attempt == self.retries:
+                        raise
+                    # The next attempt opens a new session.
+                    self.count(self.reconnects, port)
+        finally:
+            portLock.release()
+
+    def forget(self, ports):
+        """Closes the sessions of the cameras which are not on ports any more."""
+        for port in list(self.sessions.keys()):
+            if port in ports:
+                continue
+            portLock = self.portLock(port)
+            portLock.acquire()
+            try:
+                session = self.sessions.pop(port, None)
+                if session is not None:
+                    session.close()
+            finally:
+                portLock.release()
+
+    def checkIdle(self):
+        """Checks the sessions idle for longer than healthInterval, reopening
+        the ones which fail. Sessions busy capturing are left alone."""
+        for port in list(self.sessions.keys()):
+            portLock = self.portLock(port)
+            if not portLock.acquire(False):
+                continue
+            try:
+                session = self.sessions.get(port)
+                if session is None or time.time() - session.lastUsed <= self.healthInterval:
+                    continue
+                try:
+                    self.check(session)
+                except SessionError:
+                    try:
+                        self.session(session.model, port)
+                        self.count(self.reconnects, port)
+                    except SessionError:
+                        # Tried again on the next check or capture.
+                        pass
+            finally:
+                portLock.release()
+
+    def startMonitor(self):
+        if self.monitor is not None:
+            return
+        self.monitor = threading.Thread(target=self.watch)
+        self.monitor.setDaemon(True)
+        self.monitor.start()
+
+    def watch(self):
+        while True:
+            time.sleep(self.healthInterval)
+            self.checkIdle()
+
+    def status(self):
+        """Returns a JSON serializable description of the sessions."""
+        return [self.sessions[port].status() for port in sorted(self.sessions.keys())]
+
+    def close(self):
+        for port in list(self.sessions.keys()):
+            self.sessions.pop(port).close()
+        if self.temporary:
+            shutil.rmtree(self.downloadPath, True)
+
+class Gphoto2Backend(object):
+    """Captures with the cameras attached to the PC, through gphoto2.
+
+    A camera takes one picture at a time: captures on the same port (from
+    two books sharing a camera, for example) wait for each other. With
+    sessions, each camera keeps a gphoto2 shell open between captures (see
+    SessionManager, which gets sessionOptions); otherwise gphoto2 is started
+    for every capture."""
+
+    def __init__(self, ttl=30, sessions=True, sessionOptions=None):
+        self.registry = CameraRegistry(ttl)
+        self.lock = threading.Lock()
+        self.portLocks = {}
+        self.sessions = None
+        if sessions:
+            self.sessions = SessionManager(**(sessionOptions or {}))
+
+    def cameras(self):
+        cameras = self.registry.cameras()
+        if self.sessions is not None:
+            # Cameras which were unplugged do not need their shells any more.
+            self.sessions.forget([camera["port"] for camera in cameras])
+        return cameras
+
+    def close(self):
+        """Closes the gphoto2 sessions, if any."""
+        if self.sessions is not None:
+            self.sessions.close()
+
+    def capture(self, port, model, filename):
+        """Captures an image with a camera and downloads it to filename."""
+        if self.sessions is not None:
+            self.sessions.capture(port, model, filename)
+            return
+
+        self.lock.acquire()
+        try:
+            portLock = self.portLocks.setdefault(port, threading.Lock())
+        finally:
+            self.lock.release()
+
+        portLock.acquire()
+        try:
+            result = runner.run(["gphoto2", "--capture-image-and-download", "--force-overwrite",
+                                 "--port=%s" % port, "--camera=%s" % model, "--filename=%s" % filename], check=False)
+        finally:
+            portLock.release()
+        if result.status != 0 or result.timedOut:
+            raise CaptureError("Camera %s on %s could not capture: %s" % (model, port, result.stderr.strip()))
+
+class FeedBackend(object):
+    """Pretends two cameras are connected and copies images from a directory.
+
+    Each capture gets the next image of the feed, in name order."""
+
+    def __init__(self, feedPath="testData/imageFeed"):
+        self.files = sorted(glob.glob(os.path.join(feedPath, "*.jpg")))
+        if not self.files:
+            raise ValueError("There are no images in %s" % feedPath)
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def cameras(self):
+        return [dict(camera) for camera in simulatedCameras]
+
+    def capture(self, port, model, filename):
+        self.lock.acquire()
+        try:
+            source = self.files[self.next % len(self.files)]
+            self.next += 1
+        finally:
+            self.lock.release()
+        shutil.copyfile(source, filename)
+
+class SyntheticBackend(object):
+    """Pretends two cameras are connected and captures generated pages.
+
+    A few pages (lines of grey blocks standing for text) are drawn and encoded
+    when the backend is created; captures only write them out, so they cost no
+    more than the disk write."""
+
+    def __init__(self, size=(1200, 1600), variants=4, quality=85, seed=0):
+        generator = random.Random(seed)
+        self.pages = [self.render(size, quality, generator) for i in range(variants)]
+        self.next = 0
+        self.lock = threading.Lock()
+
+    def render(self, size, quality, generator):
+        """Returns the JPEG data of a page of fake text."""
+        width, height = size
+        image = Image.new("RGB", size, (245, 240, 230))
+        draw = ImageDraw.Draw(image)
+        margin = width // 10
+        line = max(4, height // 60)
+        for top in range(margin, height - margin, line * 2):
+            x = margin
+            while x < width - margin:
+                word = generator.randint(line, line * 5)
+                draw.rectangle((x, top, min(x + word, width - margin), top + line), fill=(60, 60, 60))
+                x += word + line
+        output = StringIO()
+        image.save(output, "JPEG", quality=quality)
+        return output.getvalue()
+
+    def cameras(self):
+        return [dict(camera) for camera in simulatedCameras]
+
+    def capture(self, port, model, filename):
+        self.lock.acquire()
+        try:
+            page = self.pages[self.next % len(self.pages)]
+            self.next += 1
+        finally:
+            self.lock.release()
+        file = open(filename, "wb")
+        try:
+            file.write(page)
+        finally:
+            file.close()
+
+def createCameraBackend(backend, **options):
+    """Returns the camera backend for a name: "gphoto2", "feed" or "synthetic"."""
+    if backend == "gphoto2":
+        return Gphoto2Backend(**options)
+    elif backend == "feed":
+        return FeedBackend(**options)
+    elif backend == "synthetic":
+        return SyntheticBackend(**options)
+    raise ValueError("Unknown camera backend %s" % backend)
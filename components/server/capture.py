@@ -0,0 +1,51 @@
+"""Module contains the capture engine used by the Decapod server.
+
+The engine fires all cameras of a scanning station at the same time instead of
+one after the other, so capturing a spread takes as long as the slowest camera
+rather than the sum of all of them.
+"""
+
+import sys
+import threading
+
+class CaptureEngine(object):
+    """Captures images from several cameras in parallel.
+
+    The actual capture is delegated to a function taking a port and a model
+    (for example ImageController.take_picture). Each camera gets its own thread;
+    the engine waits for all of them and returns the captured paths in the same
+    order as the cameras were given."""
+
+    def __init__(self, capture_function):
+        self.capture_function = capture_function
+
+    def capture(self, cameras):
+        """Captures one image per camera and returns the list of their paths.
+
+        If any of the cameras fails, the first error (in camera order) is raised
+        once all of the cameras have finished."""
+
+        results = [None] * len(cameras)
+        errors = [None] * len(cameras)
+
+        def run(position, camera):
+            try:
+                results[position] = self.capture_function(camera["port"], camera["model"])
+            except:
+                errors[position] = sys.exc_info()
+
+        threads = []
+        for position, camera in enumerate(cameras):
+            thread = threading.Thread(target=run, args=(position, camera))
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+        for error in errors:
+            if error is not None:
+                raise error[1]
+
+        return results
@@ -0,0 +1,375 @@
+"""Module contains the persistent image catalogue of the Decapod server.
+
+The catalogue is the ordered collection of captured spreads (the book). It is
+stored in an embedded SQLite database, so it survives restarts, and mirrored in
+memory for fast reads. Every spread gets a stable id which is never reused, and
+the order is kept in a separate position column: moving a page only updates
+that page's position, instead of rewriting the whole book.
+"""
+
+import sqlite3
+import threading
+
+import simplejson as json
+
+# Gap left between the positions of consecutive pages.
+positionStep = 1024.0
+
+class PatchError(ValueError):
+    """Raised when a patch contains an invalid operation."""
+    pass
+
+class VersionConflict(Exception):
+    """Raised when a change is based on an outdated version of the catalogue."""
+    pass
+
+schema = """
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    position REAL NOT NULL,
+    entry TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pages_position ON pages (position);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('version', 0);
+"""
+
+class Catalogue(object):
+    """An ordered, persistent collection of image entries.
+
+    Entries are dicts (the paths to the images of a spread); the entries
+    returned by the catalogue also carry their "id". Every change increments
+    the version of the catalogue, which clients can use to detect updates."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.executescript(schema)
+        self.connection.commit()
+        self.deferred = False
+        self.load()
+
+    def load(self):
+        """Reads the whole catalogue into memory."""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.positions = {}
+            self.order = []
+            cursor = self.connection.execute("SELECT id, position, entry FROM pages ORDER BY position")
+            for id, position, entry in cursor:
+                self.entries[id] = json.loads(entry)
+                self.positions[id] = position
+                self.order.append(id)
+            self.version = self.connection.execute("SELECT value FROM meta WHERE name = 'version'").fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        return len(self.order)
+
+    def __contains__(self, id):
+        return id in self.entries
+
+    def withId(self, id):
+        entry = dict(self.entries[id])
+        entry["id"] = id
+        return entry
+
+    def list(self):
+        """Returns all of the entries, in order."""
+        self.lock.acquire()
+        try:
+            return [self.withId(id) for id in self.order]
+        finally:
+            self.lock.release()
+
+    def slice(self, offset=0, limit=None):
+        """Returns the version and limit entries starting at offset, in order.
+
+        The version is read together with the entries, so it describes them."""
+        self.lock.acquire()
+        try:
+            if limit is None:
+                ids = self.order[offset:]
+            else:
+                ids = self.order[offset:offset + limit]
+            return self.version, [self.withId(id) for id in ids]
+        finally:
+            self.lock.release()
+
+    def references(self, fields):
+        """Returns the set of the values of some fields over all of the entries.
+
+        Used to tell whether any entry still refers to a file."""
+        self.lock.acquire()
+        try:
+            values = set()
+            for entry in self.entries.values():
+                for field in fields:
+                    if entry.get(field):
+                        values.add(entry[field])
+            return values
+        finally:
+            self.lock.release()
+
+    def get(self, id):
+        """Returns the entry with the given id, or None if there is none."""
+        self.lock.acquire()
+        try:
+            if not id in self.entries:
+                return None
+            return self.withId(id)
+        finally:
+            self.lock.release()
+
+    def index(self, id):
+        """Returns the position in the book (starting at 0) of an entry."""
+        self.lock.acquire()
+        try:
+            return self.order.index(id)
+        finally:
+            self.lock.release()
+
+    def append(self, entry):
+        """Adds an entry at the end of the book and returns its id."""
+        return self.insert(entry, None)
+
+    def insert(self, entry, index):
+        """Adds an entry before the page at index and returns its id.
+
+        An index of None adds the entry at the end, wherever that is once the
+        catalogue is locked."""
+        entry = self.stored(entry)
+        self.lock.acquire()
+        try:
+            if index is None:
+                index = len(self.order)
+            index = max(0, min(index, len(self.order)))
+            position = self.positionAt(index)
+            cursor = self.connection.execute("INSERT INTO pages (position, entry) VALUES (?, ?)",
+                                              (position, json.dumps(entry)))
+            id = cursor.lastrowid
+            self.changed()
+            self.entries[id] = entry
+            self.positions[id] = position
+            self.order.insert(index, id)
+            return id
+        finally:
+            self.lock.release()
+
+    def update(self, id, entry):
+        """Replaces the entry with the given id, keeping its position."""
+        entry = self.stored(entry)
+        self.lock.acquire()
+        try:
+            self.connection.execute("UPDATE pages SET entry = ? WHERE id = ?", (json.dumps(entry), id))
+            self.changed()
+            self.entries[id] = entry
+        finally:
+            self.lock.release()
+
+    def remove(self, id):
+        """Removes an entry from the book. The other ids are not affected.
+
+        Raises KeyError, changing nothing, if there is no entry with the id."""
+        self.lock.acquire()
+        try:
+            if not id in self.entries:
+                raise KeyError(id)
+            self.connection.execute("DELETE FROM pages WHERE id = ?", (id,))
+            self.changed()
+            del self.entries[id]
+            del self.positions[id]
+            self.order.remove(id)
+        finally:
+            self.lock.release()
+
+    def move(self, id, index):
+        """Moves an entry so it ends up at the given index of the book.
+
+        Only the position of the moved entry is written, unless there is no
+        room left between its new neighbours."""
+        self.lock.acquire()
+        try:
+            self.order.remove(id)
+            index = max(0, min(index, len(self.order)))
+            position = self.positionAt(index)
+            self.order.insert(index, id)
+            self.positions[id] = position
+            self.connection.execute("UPDATE pages SET position = ? WHERE id = ?", (position, id))
+            self.changed()
+        finally:
+            self.lock.release()
+
+    def replace(self, entries):
+        """Replaces the whole book with a list of entries.
+
+        Entries with the id of an existing entry update it, other entries are
+        added; existing entries missing from the list are removed. Raises
+        PatchError, changing nothing, if an entry is not an object or an id
+        is listed twice."""
+        if not isinstance(entries, list):
+            raise PatchError("The images must be a list.")
+        seen = {}
+        for entry in entries:
+            if not isinstance(entry, dict):
+                raise PatchError("Images must be objects.")
+            id = entry.get("id")
+            if id is not None:
+                if id in seen:
+                    raise PatchError("The image with id %r is listed twice." % (id,))
+                seen[id] = True
+
+        self.lock.acquire()
+        try:
+            try:
+                self.replaceEntries(entries)
+            except:
+                self.connection.rollback()
+                self.load()
+                raise
+            self.changed()
+        finally:
+            self.lock.release()
+
+    def replaceEntries(self, entries):
+        kept = {}
+        for entry in entries:
+            if entry.get("id") in self.entries:
+                kept[entry["id"]] = True
+        for id in list(self.order):
+            if not id in kept:
+                self.connection.execute("DELETE FROM pages WHERE id = ?", (id,))
+                del self.entries[id]
+                del self.positions[id]
+
+        self.order = []
+        for index, entry in enumerate(entries):
+            id = entry.get("id")
+            position = (index + 1) * positionStep
+            stored = self.stored(entry)
+            if id in kept:
+                self.connection.execute("UPDATE pages SET position = ?, entry = ? WHERE id = ?",
+                                        (position, json.dumps(stored), id))
+            else:
+                id = self.connection.execute("INSERT INTO pages (position, entry) VALUES (?, ?)",
+                                             (position, json.dumps(stored))).lastrowid
+            self.entries[id] = stored
+            self.positions[id] = position
+            self.order.append(id)
+
+    def patch(self, operations, version=None):
+        """Applies a list of small changes to the book, all or none of them.
+
+        Each operation is a dict with an "op" and its arguments:
+
+            {"op": "move", "id": 3, "index": 0}
+            {"op": "remove", "id": 5}
+            {"op": "insert", "index": 2, "entry": {...}}
+            {"op": "update", "id": 4, "entry": {...}}
+
+        Indices are positions in the book after the preceding operations have
+        been applied; an "insert" without an index appends. If version is given
+        and the catalogue has changed since, nothing is applied and
+        VersionConflict is raised. Returns the ids of the inserted entries."""
+
+        self.lock.acquire()
+        try:
+            if version is not None and version != self.version:
+                raise VersionConflict("The catalogue is at version %d, not %d." % (self.version, version))
+
+            self.deferred = True
+            inserted = []
+            try:
+                for operation in operations:
+                    inserted.extend(self.apply(operation))
+            except:
+                self.connection.rollback()
+                self.deferred = False
+                self.load()
+                raise
+            self.deferred = False
+            self.changed()
+            return inserted
+        finally:
+            self.lock.release()
+
+    def apply(self, operation):
+        if not isinstance(operation, dict):
+            raise PatchError("Operations must be objects.")
+        op = operation.get("op")
+        if op == "insert":
+            entry = operation.get("entry")
+            if not isinstance(entry, dict):
+                raise PatchError("insert needs an entry.")
+            return [self.insert(entry, self.indexOf(operation, len(self.order)))]
+
+        id = operation.get("id")
+        if not id in self.entries:
+            raise PatchError("There is no entry with id %r." % (id,))
+        if op == "move":
+            self.move(id, self.indexOf(operation))
+        elif op == "remove":
+            self.remove(id)
+        elif op == "update":
+            entry = operation.get("entry")
+            if not isinstance(entry, dict):
+                raise PatchError("update needs an entry.")
+            self.update(id, entry)
+        else:
+            raise PatchError("Unknown operation %r." % (op,))
+        return []
+
+    def indexOf(self, operation, default=None):
+        index = operation.get("index", default)
+        if not isinstance(index, (int, long)) or isinstance(index, bool):
+            raise PatchError("Operation %r needs an integer index." % operation.get("op"))
+        return index
+
+    def stored(self, entry):
+        """Returns the part of an entry that is stored (everything but its id)."""
+        entry = dict(entry)
+        entry.pop("id", None)
+        return entry
+
+    def positionAt(self, index):
+        """Returns a free position for a page inserted at index of self.order.
+
+        Renumbers the positions of the whole book if the neighbours are too
+        close to each other to fit a page in between (which takes very many
+        moves to the same place)."""
+        if not self.order:
+            return positionStep
+        if index == 0:
+            return self.positions[self.order[0]] - positionStep
+        if index >= len(self.order):
+            return self.positions[self.order[-1]] + positionStep
+
+        before = self.positions[self.order[index - 1]]
+        after = self.positions[self.order[index]]
+        position = (before + after) / 2
+        if position <= before or position >= after or after - before < 1e-6:
+            self.renumber()
+            return self.positionAt(index)
+        return position
+
+    def renumber(self):
+        for index, id in enumerate(self.order):
+            position = (index + 1) * positionStep
+            self.positions[id] = position
+            self.connection.execute("UPDATE pages SET position = ? WHERE id = ?", (position, id))
+
+    def changed(self):
+        if self.deferred:
+            return
+        self.version += 1
+        self.connection.execute("UPDATE meta SET value = ? WHERE name = 'version'", (self.version,))
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,174 @@
+"""Module contains the resized image (derivative) service of the Decapod server.
+
+Previews of captured images are generated on demand at the requested width and
+kept in two bounded LRU caches: a small one in memory and a larger one on disk.
+Generation uses the fast path of PIL: JPEGs are decoded at a reduced scale with
+draft() and large images are first reduced cheaply and only then resampled with
+the antialiasing filter, so the full-size original is decoded at most once per
+size.
+"""
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from cStringIO import StringIO
+from PIL import Image
+
+minWidth = 16
+maxWidth = 4096
+
+class DerivativeCache(object):
+    """Generates and caches resized versions of images.
+
+    Derivatives are JPEGs identified by a key made of the source path, its
+    modification time and size, and the requested dimensions; changing the
+    source therefore never serves a stale derivative."""
+
+    def __init__(self, cachePath, maxDiskSize=256 * 1024 * 1024, maxMemorySize=32 * 1024 * 1024, quality=85):
+        self.cachePath = cachePath
+        self.maxDiskSize = maxDiskSize
+        self.maxMemorySize = maxMemorySize
+        self.quality = quality
+        self.lock = threading.Lock()
+        # Least recently used first.
+        self.memory = OrderedDict()
+        self.memorySize = 0
+        self.memoryHits = 0
+        self.diskHits = 0
+        self.misses = 0
+        if not os.path.exists(cachePath):
+            os.makedirs(cachePath)
+        self.diskSize = 0
+        for name in os.listdir(cachePath):
+            self.diskSize += os.path.getsize(os.path.join(cachePath, name))
+
+    def key(self, source, width, height):
+        info = os.stat(source)
+        identity = "%s %d %d %d %d" % (os.path.abspath(source), int(info.st_mtime), info.st_size, width, height or 0)
+        return hashlib.sha1(identity).hexdigest()
+
+    def get(self, source, width, height=None):
+        """Returns the key and the JPEG data of source resized to fit width.
+
+        If height is given the image also fits into it, otherwise the aspect
+        ratio alone determines it. Raises ValueError for unsupported sizes and
+        OSError if the source does not exist."""
+
+        width = int(width)
+        height = height and int(height)
+        if width < minWidth or width > maxWidth or (height is not None and (height < minWidth or height > maxWidth)):
+            raise ValueError("Unsupported derivative size %sx%s" % (width, height))
+
+        key = self.key(source, width, height)
+        data = self.fromMemory(key)
+        if data is not None:
+            return key, data
+
+        path = os.path.join(self.cachePath, key + ".jpg")
+        try:
+            file = open(path, "rb")
+            try:
+                data = file.read()
+            finally:
+                file.close()
+            os.utime(path, None)
+            self.diskHits += 1
+        except IOError:
+            self.misses += 1
+            data = self.generate(source, width, height)
+            self.toDisk(path, data)
+
+        self.toMemory(key, data)
+        return key, data
+
+    def generate(self, source, width, height):
+        im = Image.open(source)
+        if height is None:
+            height = max(1, im.size[1] * width // im.size[0])
+        size = (width, height)
+
+        # Let the JPEG decoder do most of the downscaling.
+        if im.format == "JPEG":
+            im.draft("RGB", size)
+        if im.mode not in ("RGB", "L"):
+            im = im.convert("RGB")
+
+        # Reduce cheaply to twice the target size, then resample properly.
+        if im.size[0] > 2 * width and im.size[1] > 2 * height:
+            im = im.resize((2 * width, 2 * im.size[1] * width // im.size[0]), Image.NEAREST)
+        im.thumbnail(size, Image.ANTIALIAS)
+
+        output = StringIO()
+        im.save(output, "JPEG", quality=self.quality)
+        return output.getvalue()
+
+    def fromMemory(self, key):
+        self.lock.acquire()
+        try:
+            data = self.memory.pop(key, None)
+            if data is not None:
+                self.memory[key] = data
+                self.memoryHits += 1
+            return data
+        finally:
+            self.lock.release()
+
+    def toMemory(self, key, data):
+        if len(data) > self.maxMemorySize:
+            return
+        self.lock.acquire()
+        try:
+            if key in self.memory:
+                return
+            self.memory[key] = data
+            self.memorySize += len(data)
+            while self.memorySize > self.maxMemorySize:
+                oldest, evicted = self.memory.popitem(last=False)
+                self.memorySize -= len(evicted)
+        finally:
+            self.lock.release()
+
+    def toDisk(self, path, data):
+        temporaryPath = "%s.%d.tmp" % (path, threading.currentThread().ident or 0)
+        file = open(temporaryPath, "wb")
+        try:
+            file.write(data)
+        finally:
+            file.close()
+        os.rename(temporaryPath, path)
+
+        self.lock.acquire()
+        try:
+            self.diskSize += len(data)
+            if self.diskSize > self.maxDiskSize:
+                self.evict()
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Removes the least recently used files until the disk cache fits.
+
+        Shrinks the cache to 90% of its size, so eviction does not run again
+        on the very next miss. Must be called with the lock held."""
+        files = []
+        total = 0
+        for name in os.listdir(self.cachePath):
+            if name.endswith(".tmp"):
+                continue
+            path = os.path.join(self.cachePath, name)
+            info = os.stat(path)
+            files.append((info.st_mtime, info.st_size, path))
+            total += info.st_size
+        files.sort()
+        for mtime, size, path in files:
+            if total <= self.maxDiskSize * 9 // 10:
+                break
+            os.unlink(path)
+            total -= size
+        self.diskSize = total
+
+    def stats(self):
+        """Returns the hit and miss counters and the sizes of both caches."""
+        return {"memoryHits": self.memoryHits, "diskHits": self.diskHits, "misses": self.misses,
+                "memorySize": self.memorySize, "memoryItems": len(self.memory), "diskSize": self.diskSize}
@@ -6,36 +6,139 @@ provided uniform interface for accessing and modifying images.
 """
 
 import cherrypy
-import glob
 import os
 import simplejson as json
 import sys
+import threading
+import time
 from PIL import Image
 
-imageIndex = 0
+from cherrypy.lib import cptools
+from cherrypy.lib.static import serve_file
+
+from cameras import CaptureError, createCameraBackend
+import batch
+from capture import CaptureEngine
+from catalogue import PatchError, VersionConflict
+from derivatives import DerivativeCache
+from export import ExportManager, exportPages, pdfFilename
+from jobs import JobQueue, DONE
+from metrics import registry, timed
+import runner
+from stitching import createStitcher
+from storage import RetentionPolicy, StorageError
+from workspaces import Workspace, WorkspaceError, WorkspaceManager
+
 imagePath = "testData/capturedImages" #TODO: change to a better path FLUID-3538
+imageStates = ("left", "right", "spread", "thumb")
+cataloguePath = "testData/catalogue.sqlite"
+workspacePath = "testData/books" # where the books of /books/ are kept
+cameraBackend = "gphoto2" # or "feed" or "synthetic" to run without cameras
+cameraOptions = {} # e.g. {"feedPath": "testData/imageFeed"} for the "feed" backend, {"sessions": False} to run gphoto2 per capture
+postProcessingWorkers = 2
+stitchingBackend = "decapod" # or "pil" to stitch in-process
+stitchingOptions = {} # e.g. {"format": "jpeg", "quality": 90} for the "pil" backend
+listingCacheSize = 64
+derivativePath = "testData/derivatives"
+derivativeDiskSize = 256 * 1024 * 1024
+derivativeMemorySize = 32 * 1024 * 1024
+exportWorkers = 2
+exportBackend = "stream" # or "decapod" for the mogrify/tiffcp/decapod-genpdf.py chain
+exportOptions = {} # e.g. {"resolution": 300} for the "stream" backend
+exportCacheSize = 2 * 1024 * 1024 * 1024 # bytes of converted pages kept between exports ("decapod" backend)
+exportHistorySize = 10 # finished exports kept with their PDFs
+retentionPolicy = {} # e.g. {"dropRawAfter": 0, "recompressAfter": 30 * 24 * 3600, "quality": 75}, see storage.RetentionPolicy
+batchMaxPending = 4 # spreads a batch capture lets wait for post-processing before it pauses
+batchHistorySize = 10 # finished batch captures kept for their status
+batchStopTimeout = 10 # seconds a request stopping a batch capture waits for it
+eventPollTimeout = 25 # seconds a long-polling request for events may wait
+eventStreamDuration = 240 # seconds an event stream stays open before the client reconnects
+eventKeepAlive = 15 # seconds between keep-alive comments on an idle event stream
+
+def defaultWorkspace():
+    """Returns a workspace for the default book, served on /images/ and /pdf/.
+
+    It keeps its files where the server always kept them (imagePath,
+    cataloguePath and Export.exportPdfPath)."""
+    return Workspace("default", os.path.dirname(cataloguePath) or ".", imagePath=imagePath,
+                     cataloguePath=cataloguePath, exportPath=Export.exportPdfPath)
 
 class ImageController(object):
     """Main class for manipulating images.
 
     Exposes operations such as capturing, post-processing and deleting pictures
     and sets of pictures. All URLs are considered a path to an image or to a set
-    of images represented by a JSON file of their attributes."""
+    of images represented by a JSON file of their attributes.
+
+    The images are those of one book, kept in its workspace. The
+    post-processing queue and the derivative cache can be shared by the
+    controllers of several books."""
+
+    _cp_config = {"request.methods_with_bodies": ("POST", "PUT", "PATCH")}
+
+    def __init__(self, workspace=None, cameras=None, postProcessing=None, derivatives=None, sweeps=None):
+        self.workspace = workspace or defaultWorkspace()
+        self.images = self.workspace.catalogue
+        self.events = self.workspace.events
+        self.cameraBackend = cameras or createCameraBackend(cameraBackend, **cameraOptions)
+        self.captureEngine = CaptureEngine(self.take_picture)
+        self.postProcessing = postProcessing or JobQueue(postProcessingWorkers)
+        self.stitcher = createStitcher(stitchingBackend, **stitchingOptions)
+        self.jobs = {}
+        self.listings = (None, {})
+        self.derivatives = derivatives or DerivativeCache(derivativePath, derivativeDiskSize, derivativeMemorySize)
+        self.retention = RetentionPolicy(**retentionPolicy)
+        self.lastSweep = time.time()
+        self.sweepLock = threading.Lock()
+        # Sweeps recompress whole books: they have a queue of their own so they
+        # never hold up the stitching of new captures.
+        self.sweeps = sweeps or JobQueue(1)
+        self.sweepJob = None
+        self.sweepJobLock = threading.Lock()
+        self.batch = BatchController(self)
+        self.storage = StorageController(self)
 
-    images = []
+        registry.gauge("decapod_postprocessing_queue_depth", self.postProcessing.pending,
+                       "Spreads waiting to be stitched and thumbnailed")
+        registry.gauge("decapod_images", lambda: len(self.images), "Spreads in the catalogue", book=self.workspace.name)
+        # The derivative cache is shared by the books: its gauge reads the
+        # cache, and does not keep this (maybe removed) book alive.
+        registry.gauge("decapod_derivative_cache_total", derivativeCounts(self.derivatives),
+                       "Derivative requests by the cache level which answered them", label="result", kind="counter")
+        self.resumePostProcessing()
 
     @cherrypy.expose
     def index(self, *args, **kwargs):
         """Handles the /images/ URL - a collection of sets of images.
 
         Supports getting the list of images (GET) and adding a new image to the
-        collection (POST). Also supports changing the list of images (PUT)"""
+        collection (POST). Also supports changing the list of images, either
+        as a whole (PUT) or with a list of move/insert/remove/update operations
+        (PATCH, see Catalogue.patch). POST returns as soon as the images are
+        captured; the spread and the thumbnail are generated in the background
+        and their status can be polled on /images/:id/ (an image without a
+        status has been post-processed).
+
+        GET takes optional offset and limit parameters to return a page of the
+        list, and a fields parameter (a comma separated list such as
+        "id,thumb") to return only some of the attributes of each image.
+
+        The ETag of the collection is its version: GET answers If-None-Match
+        with 304 Not Modified, while changes sent with an If-Match header are
+        refused with 412 Precondition Failed if somebody else changed the
+        collection in the meantime."""
 
         method = cherrypy.request.method.upper()
         if method == "GET":
+            version, listing = self.listing(kwargs.get("offset"), kwargs.get("limit"), kwargs.get("fields"))
+            cherrypy.response.headers["ETag"] = '"%d"' % version
+            cherrypy.response.headers["X-Total-Count"] = str(len(self.images))
+            # Clients can follow the changes from here on, see /events.
+            cherrypy.response.headers["X-Last-Event-ID"] = str(self.events.lastId)
+            cptools.validate_etags()
             cherrypy.response.headers["Content-Type"] = "application/json"
             cherrypy.response.headers["Content-Disposition"] = "attachment; filename='Captured images.json'"
-            return json.dumps(self.images)
+            return listing
 
         elif method == "POST":
 
@@ -48,204 +151,768 @@ class ImageController(object):
             assert len(ports) >= 2
             assert len(models) >= 2
 
-            first_image  = self.take_picture(found_cameras[0]["port"], found_cameras[0]["model"])
-            second_image = self.take_picture(found_cameras[1]["port"], found_cameras[1]["model"])
+            model_entry = self.captureSpread()
 
             cherrypy.response.headers["Content-type"] = "application/json"
-            cherrypy.response.headers["Content-Disposition"] = "attachment; filename=Image%d.json" % len(self.images)
-            model_entry = {"left": first_image, "right": second_image}
-
-            #TODO: add page order correction.            
-
-            model_entry["spread"] = self.stitchImages (first_image, second_image)
-            model_entry["thumb"]  = self.generateThumbnail(model_entry["spread"])
-
-            self.images.append(model_entry)
-            return json.dumps(model_entry)
+            cherrypy.response.headers["Content-Disposition"] = "attachment; filename=Image%d.json" % model_entry["id"]
+            return json.dumps(self.withStatus(model_entry))
 
         elif method == "PUT":
             params = cherrypy.request.params
-            self.images = json.loads(params["images"])
-            return params["images"]
+            try:
+                images = json.loads(params.get("images", ""))
+                if isinstance(images, list):
+                    for image in images:
+                        # The post-processing status is not part of the stored entry.
+                        if isinstance(image, dict):
+                            image.pop("status", None)
+                self.images.lock.acquire()
+                try:
+                    self.checkVersion()
+                    before = self.images.list()
+                    self.images.replace(images)
+                    removed = [entry for entry in before if not entry["id"] in self.images]
+                finally:
+                    self.images.lock.release()
+            except ValueError as e:
+                raise cherrypy.HTTPError(400, str(e))
+            self.forget(removed)
+            self.changed()
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(self.images.list())
+
+        elif method == "PATCH":
+            params = cherrypy.request.params
+            if "patch" in params:
+                operations = params["patch"]
+            else:
+                operations = cherrypy.request.body.read()
+            try:
+                operations = json.loads(operations)
+                if not isinstance(operations, list):
+                    raise PatchError("A patch is a list of operations.")
+                removing = [operation.get("id") for operation in operations
+                            if isinstance(operation, dict) and operation.get("op") == "remove"
+                            and isinstance(operation.get("id"), (int, long))]
+                self.images.lock.acquire()
+                try:
+                    before = [self.images.get(id) for id in removing if id in self.images]
+                    inserted = self.images.patch(operations, self.expectedVersion())
+                    removed = [entry for entry in before if not entry["id"] in self.images]
+                finally:
+                    self.images.lock.release()
+            except VersionConflict:
+                raise cherrypy.HTTPError(412, "The images were changed by somebody else.")
+            except ValueError as e:
+                raise cherrypy.HTTPError(400, str(e))
+
+            self.forget(removed)
+            self.changed()
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps({"version": self.images.version, "inserted": inserted})
 
         else:
-            cherrypy.response.headers["Allow"] = "GET, POST, PUT"
+            cherrypy.response.headers["Allow"] = "GET, POST, PUT, PATCH"
             raise cherrypy.HTTPError(405)
 
+    def captureSpread(self):
+        """Captures a spread with both cameras and adds it to the book.
+
+        Returns the new entry as soon as the images are on disk; the spread and
+        the thumbnail are generated by the post-processing queue."""
+
+        cameras = self.workspace.cameras(self.cameraBackend.cameras())
+        if len(cameras) < 2:
+            raise cherrypy.HTTPError(503, "Two cameras are needed to capture a spread.")
+
+        # Both cameras are fired at the same time.
+        with registry.time("decapod_spread_capture_seconds", "Time to capture a spread with both cameras"):
+            first_image, second_image = self.captureEngine.capture(cameras[:2])
+
+        model_entry = {"left": first_image, "right": second_image}
+
+        #TODO: add page order correction.
+
+        # Stitching and thumbnailing run in the background; the paths they
+        # will write to are known up front so the client can use them.
+        model_entry["spread"] = self.spreadPath(first_image, second_image)
+        model_entry["thumb"]  = self.thumbnailPath(model_entry["spread"])
+        model_entry["id"] = self.images.append(model_entry)
+        self.postProcessLater(model_entry["id"], first_image, second_image)
+        self.events.publish("capture-complete", {"id": model_entry["id"], "left": first_image,
+                                                 "right": second_image, "version": self.images.version})
+        return model_entry
+
+    def listing(self, offset=None, limit=None, fields=None):
+        """Returns the version and the JSON text of a page of the collection.
+
+        Serialized pages are cached until the collection changes, so polling
+        clients do not cost a serialization of the whole book each time."""
+
+        try:
+            offset = int(offset or 0)
+            if limit:
+                limit = int(limit)
+            else:
+                limit = None # Missing or empty
+        except ValueError:
+            raise cherrypy.HTTPError(400, "offset and limit must be integers.")
+        if offset < 0 or (limit is not None and limit < 0):
+            raise cherrypy.HTTPError(400, "offset and limit must not be negative.")
+
+        if fields:
+            fields = tuple(fields.split(","))
+            for field in fields:
+                if field != "id" and not field in imageStates:
+                    raise cherrypy.HTTPError(400, "Unknown field %s." % field)
+
+        key = (offset, limit, fields)
+        cachedVersion, cached = self.listings
+        if cachedVersion == self.images.version and key in cached:
+            return cachedVersion, cached[key]
+
+        version, entries = self.images.slice(offset, limit)
+        if fields:
+            entries = [dict([(field, entry[field]) for field in fields if field in entry]) for entry in entries]
+        listing = json.dumps(entries)
+
+        if cachedVersion != version:
+            cached = {}
+            self.listings = (version, cached)
+        if len(cached) < listingCacheSize:
+            cached[key] = listing
+        return version, listing
+
+    def expectedVersion(self):
+        """Returns the collection version from the If-Match header, if any."""
+        match = cherrypy.request.headers.get("If-Match")
+        if not match or match.strip() == "*":
+            return None
+        try:
+            return int(match.strip().lstrip("W/").strip('"'))
+        except ValueError:
+            raise cherrypy.HTTPError(412, "The images were changed by somebody else.")
+
+    def checkVersion(self):
+        expected = self.expectedVersion()
+        if expected is not None and expected != self.images.version:
+            raise cherrypy.HTTPError(412, "The images were changed by somebody else.")
+
+    def setVersion(self):
+        cherrypy.response.headers["ETag"] = '"%d"' % self.images.version
+
+    def changed(self):
+        """Tells the client and the event stream about a change of the list."""
+        self.setVersion()
+        self.events.publish("images-changed", {"version": self.images.version})
+
     @cherrypy.expose
-    def default(self, id, state=None):
+    def default(self, id, state=None, w=None, h=None, v=None):
         """Handles the /images/:id/ and /images/:id/:state URLs.
 
-        Supports getting (GET) and deleting (DELETE) sets of images by their id.
+        Supports getting (GET) and deleting (DELETE) sets of images by their id,
+        which stays the same when other images are added, moved or deleted.
         The first operation returns a JSON text with the paths to the images. If
-        state is provided, GET returns a jpeg image with the specified state.
+        state is provided, GET streams the image with the specified state. The w
+        (and optionally h) parameter asks for a JPEG preview resized to fit; v
+        is ignored, so that a client can change it to load an image again.
         POST is supported together with state, performing some operation(s) on
         the image."""
 
-        index = int(id)
-        if index < 0 or index >= len(self.images):
+        try:
+            entry = self.images.get(int(id))
+        except ValueError:
+            entry = None
+        if entry is None:
             raise cherrypy.HTTPError(404, "The specified resource is not currently available.")
 
         method = cherrypy.request.method.upper()
         if not state:
             if method == "GET":
                 cherrypy.response.headers["Content-Type"] = "application/json"
-                cherrypy.response.headers["Content-Disposition"] = "attachment; filename=Image%d.json" % index
-                return json.dumps(self.images[index])
+                cherrypy.response.headers["Content-Disposition"] = "attachment; filename=Image%d.json" % entry["id"]
+                return json.dumps(self.withStatus(entry))
 
             elif method == "DELETE":
-                return self.delete(index)
+                self.checkVersion()
+                if not self.delete(entry["id"]):
+                    # Deleted by another request in the meantime.
+                    raise cherrypy.HTTPError(404, "The specified resource is not currently available.")
+                self.changed()
+                return
 
             else:
                 cherrypy.response.headers["Allow"] = "GET, DELETE"
                 raise cherrypy.HTTPError(405)
 
         else:
-            if method == "GET":
-                if not state in self.images[index]:
+            if method in ("GET", "HEAD"):
+                if not state in imageStates or not state in entry:
                     raise cherrypy.HTTPError(404, "The specified resource is not currently available.")
 
-                path = self.images[index][state]
-                cherrypy.response.headers["Content-type"] = "image/jpeg"
-                try:
-                    file = open(path)
-                except IOError:
-                    raise cherrypy.HTTPError(404, "Image path can not be opened")
-                    
-                content = file.read()
-                file.close()
-                return content
+                if w is not None:
+                    return self.serveDerivative(entry[state], w, h)
+                return self.serveImage(entry[state])
 
             else:
-                cherrypy.response.headers["Allow"] = "GET"
+                cherrypy.response.headers["Allow"] = "GET, HEAD"
                 raise cherrypy.HTTPError(405)
 
+    def serveImage(self, path):
+        """Streams an image file to the client.
+
+        The file is sent in chunks instead of being read into memory, with its
+        Content-Length, Last-Modified and ETag. Conditional GETs are answered
+        with 304 Not Modified and Range requests with partial content."""
+
+        try:
+            info = os.stat(path)
+        except OSError:
+            raise cherrypy.HTTPError(404, "Image path can not be opened")
+
+        cherrypy.response.headers["ETag"] = '"%x-%x"' % (int(info.st_mtime), info.st_size)
+        cptools.validate_etags()
+        cherrypy.response.stream = True
+        return serve_file(os.path.abspath(path))
+
+    def serveDerivative(self, path, width, height=None):
+        """Returns a resized version of an image, generated on first use."""
+
+        try:
+            key, data = self.derivatives.get(path, width, height)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "Unsupported image size.")
+        except (IOError, OSError):
+            raise cherrypy.HTTPError(404, "Image path can not be opened")
+
+        cherrypy.response.headers["Content-Type"] = "image/jpeg"
+        cherrypy.response.headers["ETag"] = '"%s"' % key
+        cptools.validate_etags()
+        return data
+
+    @timed("decapod_capture_seconds", "Time to capture an image with one camera")
     def take_picture(self, port=None, model=None):
         """Capture an image and save it to disk.
 
-        If the application is in testing mode, do not use a camera. Instead, get
-        an image from the local filesytem."""
+        The image is taken by the camera backend: with gphoto2, or without a
+        camera from an image feed or a generator when testing."""
 
+        imagePath = self.workspace.imagePath
+        newIndex = self.workspace.nextImageIndex()
 
         # Filename and directory declarations.
-        captureFilename = 'newDecapodCapture.jpg'
-        decapodImagePrefix = 'decapod'
-        
-        # Check save path for images.
-        # TODO: move this to server initialization so it's only done once (FLUID-3537)
-        # TODO: change the save location for files, and change the code that is depends on the directory being testdata/capturedImages/
-        if not os.access (imagePath,os.F_OK) and os.access ("./",os.W_OK):
-            status = os.system("mkdir %s" % imagePath)
-            if status !=0:
-                raise cherrypy.HTTPError(403, "Could not create path %s." % imagePath)
-        elif not os.access ("./",os.W_OK):
-            raise cherrypy.HTTPError(403, "Can not write to directory")
-
-        status = os.system("gphoto2 --capture-image-and-download --force-overwrite --port=%s --camera='%s' --filename=%s 2>>capture.log" % (port, model,captureFilename))
-        if status != 0:
+        # Several captures may run at the same time (both cameras, or several
+        # clients), so each one downloads to its own file, named after the
+        # index it was given. It is kept next to the captured images so that
+        # moving it into the store is cheap.
+        captureFilename = '%s/newDecapodCapture-%d.jpg' % (imagePath, newIndex)
+
+        try:
+            self.cameraBackend.capture(port, model, captureFilename)
+        except (CaptureError, IOError, OSError) as e:
+            cherrypy.log(str(e), "CAPTURE")
             raise cherrypy.HTTPError(500, "Camera could not capture.")
-        
-        # create new filename for image.
-        # TODO: Move filename generation to a new function. FLUID-3538
-        global imageIndex
-        imageIndex += 1
-        
-        #TODO: change newFilename = '%s-%04d.jpg' % (decapodImagePrefix,imageIndex) FLUID-3538
-        newFilename = 'Image%d.jpg' % imageIndex
 
-        status = os.system("mv -f %s %s/%s" % (captureFilename,imagePath,newFilename))
-        if status != 0:
-            raise cherrypy.HTTPError(500, "Could not rename file %s to %s/%s" % (captureFilename,imagePath,newFilename))
+        # The image is named after its contents, see storage.ContentStore.
+        try:
+            return self.workspace.store.put(captureFilename, ".jpg")
+        except StorageError as e:
+            cherrypy.log(str(e), "CAPTURE")
+            raise cherrypy.HTTPError(500, "Could not store the captured image.")
 
-        newFilePath = '%s/%s' % (imagePath,newFilename)
-        return newFilePath
+    def delete(self, id):
+        """Delete an image from the list of images and from the file system.
 
-    def delete(self, index=None):
-        """Delete an image from the list of images and from the file system."""
+        Files which other images share (identical captures) are kept. Returns
+        False if there is no image with the id (any more)."""
 
-        for filename in self.images[index].values():
-            os.unlink(filename)
-        self.images.pop(index)
-        return
+        self.images.lock.acquire()
+        try:
+            entry = self.images.get(id)
+            if entry is None:
+                return False
+            self.images.remove(id)
+        finally:
+            self.images.lock.release()
+        self.forget([entry])
+        return True
+
+    def forget(self, entries):
+        """Drops the post-processing of images removed from the catalogue and
+        removes their files, except those other images still use.
+
+        Used by every change which removes images (DELETE, PUT and PATCH).
+        The files are only removed once the post-processing of an image has
+        finished writing them."""
+
+        for entry in entries:
+            job = self.jobs.pop(entry["id"], None)
+            if job:
+                job.wait()
+        if not entries:
+            return
+        self.images.lock.acquire()
+        try:
+            self.workspace.store.release([entry.get(state) for entry in entries for state in imageStates],
+                                         self.images.references(imageStates))
+        finally:
+            self.images.lock.release()
+
+    def postProcessLater(self, id, image_one, image_two):
+        """Submits the post-processing of an image to the queue.
+
+        Its job is kept in self.jobs, for the status of the image, until it
+        has succeeded; only the jobs of failed images stay there afterwards, so
+        they do not pile up as the book grows."""
+
+        job = self.postProcessing.submit(self.postProcess, id, image_one, image_two)
+        self.jobs[id] = job
+        job.addListener(self.postProcessed)
+        return job
+
+    def resumePostProcessing(self):
+        """Submits the post-processing of the images whose spread or thumbnail
+        is missing.
+
+        Entries are stored as soon as they are captured, while their jobs only
+        live in memory: those still waiting or running when the server stopped
+        are run again."""
+
+        for entry in self.images.list():
+            if not "left" in entry or not "right" in entry:
+                continue
+            if not os.path.exists(entry.get("spread", "")) or not os.path.exists(entry.get("thumb", "")):
+                self.postProcessLater(entry["id"], entry["left"], entry["right"])
+
+    def postProcessed(self, job):
+        id = job.args[0]
+        if job.state == DONE and self.jobs.get(id) is job:
+            self.jobs.pop(id, None)
+
+    def postProcess(self, id, image_one, image_two):
+        """Stitches a pair of captured images and generates the thumbnail.
+
+        Run by the post-processing queue after the images are on disk. Each
+        step publishes an event once its image is ready."""
+        try:
+            # Identical captures share their spread, which is only made once.
+            spread = self.spreadPath(image_one, image_two)
+            if not os.path.exists(spread):
+                spread = self.stitchImages(image_one, image_two)
+            self.events.publish("stitch-complete", {"id": id, "spread": spread})
+            thumb = self.thumbnailPath(spread)
+            if not os.path.exists(thumb):
+                thumb = self.generateThumbnail(spread)
+            self.events.publish("thumbnail-ready", {"id": id, "thumb": thumb})
+        except:
+            self.events.publish("postprocessing-failed", {"id": id, "error": str(sys.exc_info()[1])})
+            raise
+        if time.time() - self.lastSweep >= self.retention.sweepInterval:
+            self.scheduleSweep()
+        return thumb
 
+    def scheduleSweep(self):
+        """Submits a sweep of the book to the sweep queue, unless one is
+        already waiting or running, and returns its job."""
+
+        self.sweepJobLock.acquire()
+        try:
+            if self.sweepJob is None or self.sweepJob.finished.isSet():
+                self.sweepJob = self.sweeps.submit(self.sweepStorage)
+            return self.sweepJob
+        finally:
+            self.sweepJobLock.release()
+
+    def sweepStorage(self):
+        """Applies the retention policy to the book and removes the stored
+        files no image refers to any more.
+
+        Returns a summary of what was done, or None if a sweep of the book is
+        already running."""
+
+        if not self.sweepLock.acquire(False):
+            return None
+        try:
+            self.lastSweep = time.time()
+            store = self.workspace.store
+            changed = 0
+            released = []
+            for entry in self.images.list():
+                job = self.jobs.get(entry["id"])
+                if job and not job.finished.isSet():
+                    continue
+                newEntry = self.retention.apply(entry, store)
+                if newEntry is None:
+                    continue
+                self.images.lock.acquire()
+                try:
+                    if self.images.get(entry["id"]) != entry:
+                        # Changed by a client in the meantime; drop our work.
+                        released.extend([newEntry.get(state) for state in imageStates])
+                        continue
+                    self.images.update(entry["id"], newEntry)
+                    released.extend([entry.get(state) for state in imageStates])
+                    changed += 1
+                finally:
+                    self.images.lock.release()
+
+            self.images.lock.acquire()
+            try:
+                references = self.images.references(imageStates)
+                freed = store.release(released, references)
+            finally:
+                self.images.lock.release()
+            collected, collectedBytes = store.collect(references, self.retention.grace)
+
+            summary = {"changed": changed, "freedBytes": freed + collectedBytes, "collectedFiles": collected,
+                       "seconds": time.time() - self.lastSweep}
+            if changed:
+                self.events.publish("images-changed", {"version": self.images.version})
+            self.events.publish("storage-swept", summary)
+            return summary
+        finally:
+            self.sweepLock.release()
+
+    def withStatus(self, entry):
+        """Returns a copy of an image entry with its post-processing status."""
+        entry = dict(entry)
+        job = self.jobs.get(entry.get("id"))
+        if job:
+            entry["status"] = job.status()
+        else:
+            entry.pop("status", None)
+        return entry
+
+    def thumbnailPath (self, filepath):
+        return os.path.splitext(filepath)[0] + "-thumb.jpg"
+
+    def spreadPath (self, image_one, image_two):
+        return self.workspace.store.derivedPath([image_one, image_two], "." + self.stitcher.extension)
+
+    @timed("decapod_thumbnail_seconds", "Time to generate a thumbnail")
     def generateThumbnail (self, filepath):
         size = 100, 146
         im = Image.open(filepath)
         im.thumbnail(size, Image.ANTIALIAS)
-        thumbnailPath = filepath[:-4] + "-thumb.jpg"
-        im.save(thumbnailPath)
+        thumbnailPath = self.thumbnailPath(filepath)
+        partialPath = self.workspace.store.partialPath(thumbnailPath)
+        im.save(partialPath)
+        os.rename(partialPath, thumbnailPath)
         return thumbnailPath
 
+    @timed("decapod_stitch_seconds", "Time to stitch a spread")
     def stitchImages (self, image_one, image_two):
-        stitchFilename = image_one.split('/').pop()
-        stitchFilename = stitchFilename[:-4] + "-" +image_two.split('/').pop()
-        stitchFilepath = imagePath + "/" + stitchFilename[:-4] + ".png"
+        # Written aside and renamed, so that a spread found at its path is
+        # always complete.
+        stitchFilepath = self.spreadPath(image_one, image_two)
+        partialPath = self.workspace.store.partialPath(stitchFilepath)
+        self.stitcher.stitch(image_one, image_two, partialPath)
+        os.rename(partialPath, stitchFilepath)
+        return stitchFilepath
+        
+class BatchController(object):
+    """Exposes the batch capture sessions of a book, on /images/batch/.
 
-        #Image Magick implementation
-        #os.system ("convert %s %s +append %s" % (image_one, image_two, stitchFilepath))
+    A session captures spreads one after the other, without a request per
+    spread, while earlier spreads are still being stitched. Only one session
+    of a book runs at a time, since they share the cameras."""
 
-        #Decapod implementation
-        os.system ("decapod-stitching %s %s -o %s" % (image_one, image_two, stitchFilepath))
+    def __init__(self, images):
+        self.images = images
+        self.sessions = {}
+        self.lastId = 0
+        self.lock = threading.Lock()
 
-        return stitchFilepath
-        
-class Export(object):
+    @cherrypy.expose
+    def index(self, count=None, interval=None):
+        """Handles the /images/batch/ URL.
+
+        GET returns the status of the sessions. POST starts a session which
+        captures count spreads (or goes on until it is stopped), one every
+        interval seconds (0 for as fast as possible), or without an interval
+        one each time it is triggered. Returns 201 Created with the status of
+        the session, or 409 Conflict if a session is already running."""
+
+        method = cherrypy.request.method.upper()
+        if method == "GET":
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps([self.sessions[id].status() for id in sorted(self.sessions)])
+
+        elif method == "POST":
+            try:
+                if count:
+                    count = int(count)
+                else:
+                    count = None
+                if interval:
+                    interval = float(interval)
+                else:
+                    interval = None
+            except ValueError:
+                raise cherrypy.HTTPError(400, "count and interval must be numbers.")
+            if (count is not None and count < 1) or (interval is not None and interval < 0):
+                raise cherrypy.HTTPError(400, "count must be positive and interval not negative.")
+
+            self.lock.acquire()
+            try:
+                for session in self.sessions.values():
+                    if session.state == batch.RUNNING:
+                        raise cherrypy.HTTPError(409, "A batch capture is already running.")
+                self.lastId += 1
+                session = batch.BatchSession(self.lastId, self.images.captureSpread, count, interval,
+                                             self.images.postProcessing.pending, batchMaxPending, self.publishProgress)
+                self.sessions[session.id] = session
+                self.forgetOldSessions()
+            finally:
+                self.lock.release()
+            session.start()
+
+            cherrypy.response.status = 201
+            cherrypy.response.headers["Location"] = "%s/" % session.id
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(session.status())
+
+        else:
+            cherrypy.response.headers["Allow"] = "GET, POST"
+            raise cherrypy.HTTPError(405)
 
     @cherrypy.expose
-    def default(self, name=None, images=[]):
-        exportPdfPath = "pdf"
+    def default(self, id, action=None):
+        """Handles the /images/batch/:id/ and /images/batch/:id/:action URLs.
 
-        # Check save path for images.
-        # TODO: move this to server initialization so it's only done once (FLUID-3537)
-        if not os.access (exportPdfPath,os.F_OK) and os.access ("./",os.W_OK):
-            status = os.system("mkdir %s" % exportPdfPath)
-            if status !=0:
-                raise cherrypy.HTTPError(403, "Could not create path %s." % exportPdfPath)
-        elif not os.access ("./",os.W_OK):
-            raise cherrypy.HTTPError(403, "Can not write to directory")
+        GET returns the status of a session and DELETE stops it. POST to
+        /images/batch/:id/trigger captures the next spread of a triggered
+        session (a foot pedal can be wired to it); POST to
+        /images/batch/:id/stop stops the session."""
 
+        try:
+            session = self.sessions.get(int(id))
+        except ValueError:
+            session = None
+        if session is None:
+            raise cherrypy.HTTPError(404, "The specified batch capture does not exist.")
+
+        method = cherrypy.request.method.upper()
+        if not action and method == "GET":
+            pass
+        elif (not action and method == "DELETE") or (action == "stop" and method == "POST"):
+            session.stop()
+            # A capture in progress is finished first.
+            session.wait(batchStopTimeout)
+        elif action == "trigger" and method == "POST":
+            if session.state != batch.RUNNING:
+                raise cherrypy.HTTPError(409, "The batch capture is not running.")
+            session.trigger()
+        elif not action:
+            cherrypy.response.headers["Allow"] = "GET, DELETE"
+            raise cherrypy.HTTPError(405)
+        elif action in ("stop", "trigger"):
+            cherrypy.response.headers["Allow"] = "POST"
+            raise cherrypy.HTTPError(405)
+        else:
+            raise cherrypy.HTTPError(404, "The specified resource is not currently available.")
+
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        return json.dumps(session.status())
+
+    def forgetOldSessions(self):
+        finished = [id for id in sorted(self.sessions) if self.sessions[id].state != batch.RUNNING]
+        for id in finished[:-batchHistorySize]:
+            del self.sessions[id]
+
+    def publishProgress(self, session):
+        self.images.events.publish("batch-progress", session.status())
+
+    def stop(self):
+        """Stops all of the sessions and waits for them."""
+        for session in list(self.sessions.values()):
+            session.stop()
+            session.wait()
+
+class StorageController(object):
+    """Exposes the disk usage of a book and its retention policy, on
+    /images/storage/."""
+
+    def __init__(self, images):
+        self.images = images
+
+    @cherrypy.expose
+    def index(self):
+        """Handles the /images/storage/ URL.
+
+        GET returns a report of the disk space used by the images of the book
+        (see storage.ContentStore.usage) with the retention policy. POST
+        applies the policy now rather than at the next sweep; it runs in the
+        background and reports its result in a "storage-swept" event."""
 
         method = cherrypy.request.method.upper()
         if method == "GET":
-            file = open(exportPdfPath + name)
-            content = file.read()
-            file.close()
-            return content
+            images = self.images
+            report = images.workspace.store.usage(images.images.list(), imageStates)
+            report["policy"] = images.retention.describe()
+            report["lastSweep"] = images.lastSweep
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(report)
+
         elif method == "POST":
-            images = json.loads(cherrypy.request.params["images"])
-            fileStr = ''
-            for img in images:
-                fileStr += '%s %s ' % (img['left'], img['right'])
-
-            #TODO: make export asynchronous and abstracted from server.
-            #TODO: change new filename FLUID-3538
-            # hard coding the clean up of the pdf directory because a bug here can do some damage 
-            # this will be removed post 0.3 when the implementation details of pdf generation are abstracted from CherryPY
-            os.system("rm -rf pdf/tmpdir")
-            os.system("rm pdf/*")
-            status = os.system("mogrify -path %s -format tiff %s" % (exportPdfPath, fileStr))
-            if status !=0:
-                raise cherrypy.HTTPError(500, "Could not create path %s." % exportPdfPath)
-
-            status = os.system("tiffcp %s/*.tiff %s/multi-page.tiff" % (exportPdfPath, exportPdfPath))
-            if status !=0:
-                raise cherrypy.HTTPError(500, "Could not generate tiff")
-
-            status = os.system("decapod-genpdf.py -d %s/tmpdir -p %s/DecapodExport.pdf -b %s/multi-page.tiff -v 1" % (exportPdfPath, exportPdfPath, exportPdfPath)) 
-            #TODO: give a better export PDF filename
-            if status !=0:
-                raise cherrypy.HTTPError(500, "Could not create PDF." )
-
-            return exportPdfPath + "/DecapodExport.pdf" 
+            self.images.scheduleSweep()
+            cherrypy.response.status = 202
+            return
+
         else:
             cherrypy.response.headers["Allow"] = "GET, POST"
             raise cherrypy.HTTPError(405)
 
+class Export(object):
+    """Exposes the PDF export of sets of images.
+
+    Exports run in the background, each in its own work directory, so several
+    of them can exist at the same time. They are kept in the workspace of a
+    book, whose exports are served on url; queue, if given, is the job queue
+    running the exports, which can be shared by several books."""
+
+    exportPdfPath = "pdf"
+
+    def __init__(self, workspace=None, queue=None, url="/pdf"):
+        self.workspace = workspace or defaultWorkspace()
+        self.url = url
+        self.exports = ExportManager(self.workspace.exportPath, exportWorkers, exportCacheSize, exportBackend,
+                                     exportOptions, self.publishProgress, queue, exportHistorySize,
+                                     self.workspace.name)
+
+    @cherrypy.expose
+    def default(self, id=None, name=None, images=[], stream=None):
+        """Handles the /pdf/, /pdf/:id/ and /pdf/:id/:name URLs.
+
+        POST to /pdf/ starts a new export of the images passed as JSON and
+        returns 202 Accepted with the export status; with a true stream
+        parameter the PDF itself is returned instead, sent page by page while
+        it is written. GET /pdf/:id/ returns the
+        status (stage and progress) of an export and GET /pdf/:id/:name returns
+        the generated PDF once the export is done. DELETE /pdf/:id/ removes an
+        export and its files."""
+
+        method = cherrypy.request.method.upper()
+        if id is None:
+            if method == "POST":
+                images = json.loads(cherrypy.request.params["images"])
+                if stream and stream.lower() in ("1", "true", "yes"):
+                    return self.streamPdf(images)
+                export = self.exports.create(images)
+
+                cherrypy.response.status = 202
+                cherrypy.response.headers["Location"] = "%s/%s/" % (self.url, export.id)
+                cherrypy.response.headers["Content-Type"] = "application/json"
+                return json.dumps(self.status(export))
+            else:
+                cherrypy.response.headers["Allow"] = "POST"
+                raise cherrypy.HTTPError(405)
+
+        export = self.exports.get(id)
+        if export is None:
+            raise cherrypy.HTTPError(404, "The specified export does not exist.")
+
+        if not name:
+            if method == "GET":
+                cherrypy.response.headers["Content-Type"] = "application/json"
+                return json.dumps(self.status(export))
+            elif method == "DELETE":
+                self.exports.remove(id)
+                return
+            else:
+                cherrypy.response.headers["Allow"] = "GET, DELETE"
+                raise cherrypy.HTTPError(405)
+
+        if method == "GET":
+            if name != pdfFilename:
+                raise cherrypy.HTTPError(404, "The specified resource is not currently available.")
+            if export.job.state != DONE:
+                raise cherrypy.HTTPError(409, "The export is not finished yet.")
+            return serve_file(os.path.abspath(export.pdfPath()), "application/pdf")
+        else:
+            cherrypy.response.headers["Allow"] = "GET"
+            raise cherrypy.HTTPError(405)
+
+    def streamPdf(self, images):
+        """Sends the PDF of a list of images as it is written.
+
+        Nothing but the page being written is held in memory, however long
+        the book. Missing pages are reported before the response starts."""
+        try:
+            pages = exportPages(images)
+        except (KeyError, TypeError):
+            raise cherrypy.HTTPError(400, "Every image needs a left and a right page, or a spread.")
+        for page in pages:
+            if not os.path.isfile(page):
+                raise cherrypy.HTTPError(400, "The page %s does not exist." % page)
+
+        cherrypy.response.headers["Content-Type"] = "application/pdf"
+        cherrypy.response.headers["Content-Disposition"] = "attachment; filename=%s" % pdfFilename
+        cherrypy.response.stream = True
+        return self.exports.writer().chunks(pages)
+
+    def publishProgress(self, export):
+        self.workspace.events.publish("export-progress", self.status(export))
+
+    def status(self, export):
+        """Returns the status of an export, with the URL of its PDF when done."""
+        status = export.status()
+        if export.job.state == DONE:
+            status["pdf"] = "%s/%s/%s" % (self.url, export.id, pdfFilename)
+        return status
+
+def derivativeCounts(cache):
+    """Returns a function reading the hits of a derivative cache, by level."""
+    def read():
+        return {"memory": cache.memoryHits, "disk": cache.diskHits, "miss": cache.misses}
+    return read
+
+def commandStatistics(counter):
+    """Returns a function reading one counter of the runner, by tool."""
+    def read():
+        statistics = runner.defaultRunner.statistics()
+        return dict([(tool, stats[counter]) for tool, stats in statistics.items()])
+    return read
+
+registry.gauge("decapod_command_calls_total", commandStatistics("calls"), "External commands run", label="tool", kind="counter")
+registry.gauge("decapod_command_failures_total", commandStatistics("failures"), "External commands which failed", label="tool", kind="counter")
+registry.gauge("decapod_command_timeouts_total", commandStatistics("timeouts"), "External commands killed after their timeout", label="tool", kind="counter")
+registry.gauge("decapod_command_seconds_total", commandStatistics("seconds"), "Time spent running external commands", label="tool", kind="counter")
+registry.gauge("decapod_command_running", commandStatistics("running"), "External commands running", label="tool")
+registry.gauge("decapod_command_waiting", commandStatistics("waiting"), "External commands waiting for a free slot", label="tool")
+
+def registerCameraMetrics(cameras):
+    """Registers the metrics of the gphoto2 sessions of a camera backend.
+
+    Captures through the sessions do not go through the command runner, so
+    they have metrics of their own: the sessions connected, the captures and
+    the reconnects and failed health checks, by port."""
+    sessions = getattr(cameras, "sessions", None)
+    if sessions is None:
+        return
+    def connected():
+        return dict([(session["port"], int(session["connected"])) for session in sessions.status()])
+    registry.gauge("decapod_camera_sessions_connected", connected, "Cameras with an open gphoto2 session", label="port")
+    registry.gauge("decapod_camera_captures_total", lambda: sessions.counts(sessions.captures),
+                   "Images captured through gphoto2 sessions", label="port", kind="counter")
+    registry.gauge("decapod_camera_reconnects_total", lambda: sessions.counts(sessions.reconnects),
+                   "gphoto2 sessions reopened after a failure", label="port", kind="counter")
+    registry.gauge("decapod_camera_health_check_failures_total", lambda: sessions.counts(sessions.checkFailures),
+                   "Health checks of gphoto2 sessions which failed", label="port", kind="counter")
+
+# Links of Capture.html and the URLs they are served on (see dserver.conf).
+captureAssetPaths = (("../../../infusion/", "/infusion/"), ("../js/", "/js/"), ("../css/", "/css/"))
+
 class DecapodServer(object):
     """Main class for the Decapod server.
 
     Exposes the index and capture pages as a starting point for working with the
-    application. Does not expose any image-related functionality."""
+    application, the server metrics and the event stream. Does not expose any
+    image-related functionality."""
+
+    def __init__(self, cameras=None, workspace=None):
+        self.cameraBackend = cameras or createCameraBackend(cameraBackend, **cameraOptions)
+        self.workspace = workspace or defaultWorkspace()
 
     @cherrypy.expose
     def index(self):
@@ -257,52 +924,250 @@ class DecapodServer(object):
         file = open(html_path)
         content = file.read()
         file.close()
+        # The page is served on /capture and on /books/:name/capture: make
+        # its (file relative) links to scripts and styles absolute, so they
+        # resolve to the static directories of dserver.conf from both.
+        for relative, absolute in captureAssetPaths:
+            content = content.replace('"%s' % relative, '"%s' % absolute)
         return content
 
     @cherrypy.expose
-    def cameras(self):
-        """Detects the cameras locally attached to the PC.
+    def metrics(self):
+        """Returns the server metrics in the Prometheus text format.
 
-        Returns a JSON document, describing the camera and its capabilities:
-        model, port, download support, and capture support."""
-        global found_cameras
-
-        found_cameras = []
-        status = os.system("gphoto2 --auto-detect | grep '^Model\|^-' -v >/tmp/output.tmp")
-        if status != 0:
-            return json.dumps(found_cameras)
-
-        file = open("/tmp/output.tmp")
-        for line in file:
-            info = line.split()
-            port = info.pop().rstrip("\n")
-            if port.endswith(":"):
-                continue
-            model = " ".join(info)
+        Covers the latency of capture, stitching, thumbnail and export stages,
+        the depth of the work queues, cache hits and external commands."""
 
-            status = os.system("gphoto2 --summary --camera='%s' --port=%s" % (model, port))
-            if status != 0:
-                capture = False
-                download = False
+        cherrypy.response.headers["Content-Type"] = "text/plain; version=0.0.4"
+        return registry.render()
+
+    @cherrypy.expose
+    def events(self, since=None, timeout=None):
+        """Publishes what happens on the server, as it happens.
+
+        Events are capture-complete, stitch-complete, thumbnail-ready and
+        postprocessing-failed (with the id of the image), images-changed (with
+        the new version of the list) and export-progress (with the status of
+        the export). Clients which ask for text/event-stream get Server-Sent
+        Events; others get a long-polling JSON answer with the events after
+        since, waiting up to timeout seconds for one. Both resume after the id
+        given in a Last-Event-ID header or the since parameter; a "reset" event
+        means events were missed and the client should reload its state."""
+
+        lastId = cherrypy.request.headers.get("Last-Event-ID", since)
+        try:
+            if lastId:
+                lastId = int(lastId)
             else:
-                status = os.system("gphoto2 --summary --camera='%s' --port=%s | grep 'Generic Image Capture'" % (model, port))
-                capture = (status == 0)
-                
-                status = os.system("gphoto2 --summary --camera='%s' --port=%s | grep 'No File Download'" % (model, port))
-                download = (status != 0)
+                # Missing or empty (a client which does not know an id yet).
+                lastId = None
+            timeout = min(float(timeout or eventPollTimeout), eventPollTimeout)
+        except ValueError:
+            raise cherrypy.HTTPError(400, "since and timeout must be numbers.")
+        if lastId is None:
+            lastId = self.workspace.events.lastId
 
-            camera = {"model": model, "port": port, "capture": capture, "download": download}
-            found_cameras.append(camera)
+        if "text/event-stream" in cherrypy.request.headers.get("Accept", ""):
+            cherrypy.response.headers["Content-Type"] = "text/event-stream"
+            cherrypy.response.headers["Cache-Control"] = "no-cache"
+            cherrypy.response.stream = True
+            return self.eventStream(lastId)
 
+        found = self.workspace.events.since(lastId, timeout)
+        if found:
+            lastId = found[-1].id
+        cherrypy.response.headers["Content-Type"] = "application/json"
+        cherrypy.response.headers["Cache-Control"] = "no-cache"
+        return json.dumps({"last": lastId, "events": [event.asDict() for event in found]})
 
-        file.close()
+    def eventStream(self, lastId):
+        """Yields events in the text/event-stream format.
+
+        The stream ends after eventStreamDuration seconds, so idle clients do
+        not hold a server thread forever; EventSource reconnects by itself.
+        Still, every open capture page holds a server thread, which is why
+        dserver.conf raises server.thread_pool."""
+        yield "retry: 3000\n\n"
+        end = time.time() + eventStreamDuration
+        while time.time() < end:
+            found = self.workspace.events.since(lastId, min(eventKeepAlive, end - time.time()))
+            if not found:
+                yield ": keep-alive\n\n"
+            for event in found:
+                lastId = event.id
+                yield event.format()
+
+    @cherrypy.expose
+    def cameras(self):
+        """Detects the cameras locally attached to the PC.
+
+        Returns a JSON document, describing the camera and its capabilities:
+        model, port, download support, and capture support. The cameras are
+        probed in the background, so this answers from memory. Books which
+        were given camera ports only list those cameras."""
 
         cherrypy.response.headers["Content-type"] = "application/json"
         cherrypy.response.headers["Content-Disposition"] = "attachment; filename=found_cameras.json"
-        return json.dumps(found_cameras)
+        return json.dumps(self.workspace.cameras(self.cameraBackend.cameras()))
+
+class Book(DecapodServer):
+    """Exposes one of the books of /books/.
+
+    A book has the same URLs as the server itself (images, pdf, events,
+    cameras and the capture page) under /books/:name/, working on the files
+    of its own workspace."""
+
+    def __init__(self, books, workspace):
+        DecapodServer.__init__(self, books.cameraBackend, workspace)
+        self.books = books
+        self.images = ImageController(workspace, books.cameraBackend, books.postProcessing, books.derivatives,
+                                      books.sweeps)
+        self.pdf = Export(workspace, books.exportQueue, "/books/%s/pdf" % workspace.name)
+
+    @cherrypy.expose
+    def index(self):
+        """Handles the /books/:name/ URL.
+
+        GET returns a description of the book: its name, camera ports, number
+        of images and version. DELETE removes the book and all of its files."""
+
+        method = cherrypy.request.method.upper()
+        if method == "GET":
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(self.workspace.describe())
+        elif method == "DELETE":
+            self.books.remove(self.workspace.name)
+            return
+        else:
+            cherrypy.response.headers["Allow"] = "GET, DELETE"
+            raise cherrypy.HTTPError(405)
+
+    def wait(self):
+        """Stops batch captures and waits for the post-processing, the storage
+        sweep and the exports of the book."""
+        self.images.batch.stop()
+        for job in list(self.images.jobs.values()):
+            job.wait()
+        if self.images.sweepJob:
+            self.images.sweepJob.wait()
+        self.pdf.exports.wait()
+
+class Books(object):
+    """Exposes /books/, the books scanned with the server.
+
+    Several scanning stations can use one server, each working on its own
+    book: every book has its own directory, catalogue, image numbering and
+    events, and may be restricted to the cameras of one station. The work
+    queues and the derivative cache are shared by all of the books."""
+
+    def __init__(self, cameras, workspaces, postProcessing, derivatives, exportQueue, sweeps):
+        self.cameraBackend = cameras
+        self.workspaces = workspaces
+        self.postProcessing = postProcessing
+        self.sweeps = sweeps
+        self.derivatives = derivatives
+        self.exportQueue = exportQueue
+        self.books = {}
+        self.lock = threading.Lock()
+
+    @cherrypy.expose
+    def index(self, name=None, ports=None):
+        """Handles the /books/ URL.
+
+        GET returns the list of books. POST creates a new book, with the given
+        name (or a generated one) and optionally the ports of the cameras it
+        is scanned with, as repeated ports parameters or a JSON list."""
+
+        method = cherrypy.request.method.upper()
+        if method == "GET":
+            books = [self.book(name) for name in self.workspaces.names()]
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps([book.workspace.describe() for book in books if book is not None])
+
+        elif method == "POST":
+            if isinstance(ports, basestring):
+                # Ports such as "usb:002,012" contain commas, so lists of them
+                # are sent as JSON.
+                if ports.startswith("["):
+                    try:
+                        ports = json.loads(ports)
+                    except ValueError:
+                        raise cherrypy.HTTPError(400, "ports is not a valid JSON list.")
+                else:
+                    ports = [ports]
+            if name is not None and hasattr(self, name):
+                raise cherrypy.HTTPError(400, "%s can not be used as the name of a book." % name)
+            try:
+                workspace = self.workspaces.create(name, ports or None)
+            except WorkspaceError as e:
+                raise cherrypy.HTTPError(409, str(e))
+
+            cherrypy.response.status = 201
+            cherrypy.response.headers["Location"] = "/books/%s/" % workspace.name
+            cherrypy.response.headers["Content-Type"] = "application/json"
+            return json.dumps(self.book(workspace.name).workspace.describe())
+
+        else:
+            cherrypy.response.headers["Allow"] = "GET, POST"
+            raise cherrypy.HTTPError(405)
+
+    def _cp_dispatch(self, vpath):
+        book = self.book(vpath[0])
+        if book is None:
+            return None
+        vpath.pop(0)
+        return book
+
+    def book(self, name):
+        """Returns the Book with the given name, or None if there is none."""
+        self.lock.acquire()
+        try:
+            if not name in self.books:
+                workspace = self.workspaces.get(name)
+                if workspace is None:
+                    return None
+                self.books[name] = Book(self, workspace)
+            return self.books[name]
+        finally:
+            self.lock.release()
+
+    def remove(self, name):
+        """Removes a book once its post-processing and exports are done."""
+        self.lock.acquire()
+        try:
+            book = self.books.pop(name, None)
+        finally:
+            self.lock.release()
+        if book is not None:
+            book.wait()
+        registry.remove("decapod_images", book=name)
+        registry.remove("decapod_export_page_cache_total", book=name)
+        self.workspaces.remove(name)
+
+def createServer(backend=None, **options):
+    """Builds the whole server: the root, /images, /pdf and /books.
+
+    backend names the camera backend (cameraBackend by default) and options
+    are passed to it; the same backend is shared by all of the server, as
+    are the work queues and the derivative cache."""
+    if backend is None:
+        backend, options = cameraBackend, cameraOptions
+    cameras = createCameraBackend(backend, **options)
+    registerCameraMetrics(cameras)
+    if hasattr(cameras, "close"):
+        # Closes the gphoto2 sessions and removes their download directory.
+        cherrypy.engine.subscribe("stop", cameras.close)
+    workspace = defaultWorkspace()
+    postProcessing = JobQueue(postProcessingWorkers)
+    derivatives = DerivativeCache(derivativePath, derivativeDiskSize, derivativeMemorySize)
+    exportQueue = JobQueue(exportWorkers)
+    sweeps = JobQueue(1)
+
+    root = DecapodServer(cameras, workspace)
+    root.images = ImageController(workspace, cameras, postProcessing, derivatives, sweeps)
+    root.pdf = Export(workspace, exportQueue)
+    root.books = Books(cameras, WorkspaceManager(workspacePath), postProcessing, derivatives, exportQueue, sweeps)
+    return root
 
 if __name__ == "__main__":
-    root = DecapodServer()
-    root.images = ImageController()
-    root.pdf = Export()
-    cherrypy.quickstart(root, "/", "dserver.conf")
+    cherrypy.quickstart(createServer(), "/", "dserver.conf")
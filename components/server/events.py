@@ -0,0 +1,74 @@
+"""Module contains the event stream of the Decapod server.
+
+Clients learn about captured spreads, finished stitching and thumbnails, and
+export progress from events pushed by the server instead of polling /images/
+and /pdf/. Every event gets an increasing id and the most recent ones are kept
+in memory, so a client that reconnects can ask for the events it missed.
+"""
+
+import threading
+import time
+from collections import deque
+
+import simplejson as json
+
+class Event(object):
+    """Something which happened on the server: an id, a type and its data."""
+
+    def __init__(self, id, type, data):
+        self.id = id
+        self.type = type
+        self.data = data
+
+    def asDict(self):
+        return {"id": self.id, "type": self.type, "data": self.data}
+
+    def format(self):
+        """Returns the event in the text/event-stream format."""
+        return "id: %d\nevent: %s\ndata: %s\n\n" % (self.id, self.type, json.dumps(self.data))
+
+class EventBus(object):
+    """Publishes events to any number of waiting clients.
+
+    Keeps the last historySize events. Clients asking for events after an id
+    which is no longer kept get a single "reset" event instead, telling them
+    to reload the whole state."""
+
+    def __init__(self, historySize=1000):
+        self.history = deque(maxlen=historySize)
+        self.lastId = 0
+        self.condition = threading.Condition()
+
+    def publish(self, type, data):
+        """Adds an event and wakes up the clients waiting for one."""
+        self.condition.acquire()
+        try:
+            self.lastId += 1
+            event = Event(self.lastId, type, data)
+            self.history.append(event)
+            self.condition.notifyAll()
+            return event
+        finally:
+            self.condition.release()
+
+    def since(self, lastId, timeout=0):
+        """Returns the events published after lastId.
+
+        Waits up to timeout seconds for one if there is none yet; returns an
+        empty list if nothing happened in that time."""
+        deadline = time.time() + timeout
+        self.condition.acquire()
+        try:
+            while True:
+                if lastId > self.lastId or (self.history and lastId < self.history[0].id - 1):
+                    # The client missed events which were dropped (or knows
+                    # ids from a previous run of the server).
+                    return [Event(self.lastId, "reset", {})]
+                if lastId < self.lastId:
+                    return [event for event in self.history if event.id > lastId]
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return []
+                self.condition.wait(remaining)
+        finally:
+            self.condition.release()
@@ -0,0 +1,258 @@
+"""Module contains the PDF export subsystem of the Decapod server.
+
+Every export is a job with its own id and work directory, run in the background
+by a JobQueue. This way a long book does not tie up an HTTP request while the
+PDF is generated and several exports can exist (and run) at the same time.
+
+The PDF is written by one of two backends: "stream" embeds the captured JPEGs
+in the PDF page by page (see pdfwriter), "decapod" converts every page to TIFF,
+combines them with tiffcp and runs decapod-genpdf.py on the result.
+"""
+
+import os
+import re
+import shutil
+import threading
+import uuid
+
+import jobs
+import runner
+from metrics import registry
+from pdfwriter import PdfError, PdfWriter
+from tiffcache import TiffCache
+
+pdfFilename = "DecapodExport.pdf"
+
+# Names of the work directories of exports (their ids).
+exportIdPattern = re.compile(r"^[0-9a-f]{32}$")
+
+class ExportError(Exception):
+    """Raised when one of the steps of an export fails."""
+    pass
+
+def exportPages(images):
+    """Returns the paths of the pages of a list of images, in order.
+
+    Spreads whose halves were dropped by the retention policy are exported as
+    one page, their stitched image."""
+    pages = []
+    for image in images:
+        if "left" in image:
+            pages.extend([image["left"], image["right"]])
+        else:
+            pages.append(image["spread"])
+    return pages
+
+class ExportJob(object):
+    """A single PDF export of a list of images.
+
+    Keeps track of the export progress: the current stage and how many of the
+    pages have already been processed. With a writer, the pages are written
+    straight to the PDF; otherwise they are converted through a shared
+    TiffCache, so only pages which changed since a previous export cost a
+    conversion."""
+
+    def __init__(self, id, workDir, images, cache, writer=None, listener=None):
+        self.id = id
+        self.workDir = workDir
+        self.images = images
+        self.cache = cache
+        self.writer = writer
+        self.listener = listener
+        self.stage = "queued"
+        self.done = 0
+        try:
+            self.total = len(exportPages(images))
+        except (KeyError, TypeError):
+            # Invalid images make the export fail when it runs.
+            self.total = 0
+        self.percent = 0
+        self.job = None
+
+    def pdfPath(self):
+        return os.path.join(self.workDir, pdfFilename)
+
+    def run(self):
+        if not os.path.exists(self.workDir):
+            os.makedirs(self.workDir)
+        pages = exportPages(self.images)
+
+        if self.writer is not None:
+            self.setStage("writing")
+            with self.timeStage():
+                try:
+                    self.writer.write(pages, self.pdfPath(), self.pageConverted)
+                except (PdfError, IOError, OSError) as e:
+                    raise ExportError("Could not create PDF: %s" % e)
+            self.setStage("finished")
+            return self.pdfPath()
+
+        self.setStage("converting")
+        with self.timeStage():
+            try:
+                tiffs = self.cache.convert(pages, self.pageConverted)
+            except Exception as e:
+                raise ExportError(str(e))
+
+        self.setStage("combining")
+        multiPage = os.path.join(self.workDir, "multi-page.tiff")
+        with self.timeStage():
+            try:
+                runner.run(["tiffcp"] + tiffs + [multiPage])
+            except runner.CommandError as e:
+                raise ExportError("Could not generate tiff: %s" % e)
+            finally:
+                self.cache.release(tiffs)
+
+        self.setStage("generating")
+        with self.timeStage():
+            try:
+                runner.run(["decapod-genpdf.py", "-d", os.path.join(self.workDir, "tmpdir"),
+                            "-p", self.pdfPath(), "-b", multiPage, "-v", "1"])
+            except runner.CommandError as e:
+                raise ExportError("Could not create PDF: %s" % e)
+
+        self.setStage("finished")
+        return self.pdfPath()
+
+    def timeStage(self):
+        return registry.time("decapod_export_stage_seconds", "Time spent in each stage of an export", stage=self.stage)
+
+    def setStage(self, stage):
+        self.stage = stage
+        self.changed()
+
+    def pageConverted(self, page):
+        self.done += 1
+        # Tell the listener about every percent of progress, not every page.
+        percent = self.done * 100 // max(self.total, 1)
+        if percent != self.percent:
+            self.percent = percent
+            self.changed()
+
+    def changed(self):
+        if self.listener and self.job is not None:
+            self.listener(self)
+
+    def status(self):
+        """Returns a JSON serializable description of the export progress."""
+        status = {"id": self.id, "stage": self.stage,
+                  "progress": {"done": self.done, "total": self.total}}
+        status.update(self.job.status())
+        return status
+
+class ExportManager(object):
+    """Creates, runs and keeps track of export jobs.
+
+    Each export gets a work directory named after its id inside exportPath.
+    backend is "stream" or "decapod"; options are passed to the PdfWriter of
+    the "stream" backend. With the "decapod" backend, converted pages are
+    shared by all exports through a cache kept in the "cache" directory of
+    exportPath, holding at most cacheSize bytes.
+
+    listener, if given, is called with an export whenever its stage or
+    progress changes, and once it has finished or failed. Exports are run by
+    queue if one is given (it can be shared by several managers), otherwise
+    by a queue of their own with the given number of workers.
+
+    Only the last historySize finished exports are kept, with their PDFs; the
+    work directories left by a previous run of the server are removed when
+    the manager is created. book names the book the exports are made from in
+    the metrics of the page cache."""
+
+    def __init__(self, exportPath, workers=2, cacheSize=2 * 1024 * 1024 * 1024, backend="stream", options={},
+                 listener=None, queue=None, historySize=10, book="default"):
+        if not backend in ("stream", "decapod"):
+            raise ValueError("Unknown export backend %s" % backend)
+        self.exportPath = exportPath
+        self.backend = backend
+        self.options = options
+        self.listener = listener
+        self.queue = queue or jobs.JobQueue(workers)
+        self.cache = None
+        if backend == "decapod":
+            self.cache = TiffCache(os.path.join(exportPath, "cache"), cacheSize)
+
+        registry.gauge("decapod_export_queue_depth", self.queue.pending, "Exports waiting for a worker")
+        registry.gauge("decapod_export_page_cache_total", self.cacheCounts, "Page conversions looked up in the cache",
+                       label="result", kind="counter", book=book)
+        self.historySize = historySize
+        self.exports = {}
+        self.order = []
+        self.lock = threading.Lock()
+        self.removeStale()
+
+    def removeStale(self):
+        """Removes the work directories of the exports of a previous run."""
+        if not os.path.isdir(self.exportPath):
+            return
+        for name in os.listdir(self.exportPath):
+            path = os.path.join(self.exportPath, name)
+            if exportIdPattern.match(name) and os.path.isdir(path):
+                shutil.rmtree(path, True)
+
+    def create(self, images):
+        """Schedules a new export of the given images and returns its job."""
+        id = uuid.uuid4().hex
+        writer = None
+        if self.backend == "stream":
+            writer = self.writer()
+        export = ExportJob(id, os.path.join(self.exportPath, id), images, self.cache, writer, self.listener)
+        self.lock.acquire()
+        try:
+            self.exports[id] = export
+            self.order.append(id)
+            export.job = self.queue.submit(export.run)
+            forgotten = self.forgetOldExports()
+        finally:
+            self.lock.release()
+        for old in forgotten:
+            shutil.rmtree(old.workDir, True)
+        if self.listener:
+            export.job.addListener(lambda job: self.listener(export))
+        return export
+
+    def forgetOldExports(self):
+        """Forgets the oldest finished exports beyond historySize and returns
+        them. Must be called with the lock held."""
+        finished = [id for id in self.order if self.exports[id].job.finished.isSet()]
+        forgotten = []
+        for id in finished[:max(0, len(finished) - self.historySize)]:
+            self.order.remove(id)
+            forgotten.append(self.exports.pop(id))
+        return forgotten
+
+    def writer(self):
+        """Returns a new PdfWriter with the options of the manager."""
+        return PdfWriter(**self.options)
+
+    def cacheCounts(self):
+        if self.cache is None:
+            return {"hit": 0, "miss": 0}
+        return {"hit": self.cache.hits, "miss": self.cache.misses}
+
+    def get(self, id):
+        """Returns the export with the given id, or None if there is none."""
+        return self.exports.get(id)
+
+    def wait(self):
+        """Waits for all of the exports to finish."""
+        for export in list(self.exports.values()):
+            export.job.wait()
+
+    def remove(self, id):
+        """Forgets an export and removes its work directory.
+
+        The export is waited for if it is still running."""
+        self.lock.acquire()
+        try:
+            export = self.exports.pop(id, None)
+            if export is not None:
+                self.order.remove(id)
+        finally:
+            self.lock.release()
+        if export is None:
+            return False
+        export.job.wait()
+        shutil.rmtree(export.workDir, True)
+        return True
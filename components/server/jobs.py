@@ -0,0 +1,107 @@
+"""Module contains a simple background job queue for the Decapod server.
+
+Long running work (stitching, thumbnails, exports) is submitted to a queue and
+run by a pool of worker threads, so HTTP requests can return as soon as the
+work is scheduled. Every job keeps track of its state, which clients can poll.
+"""
+
+import sys
+import threading
+import Queue
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class Job(object):
+    """A unit of work run by a JobQueue.
+
+    Holds the function to run with its arguments, the current state of the job
+    and, once it has finished, either its result or the error it failed with."""
+
+    def __init__(self, function, args=(), kwargs=None):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.state = PENDING
+        self.result = None
+        self.error = None
+        self.finished = threading.Event()
+        self.listeners = []
+        self.lock = threading.Lock()
+
+    def run(self):
+        self.state = RUNNING
+        try:
+            self.result = self.function(*self.args, **self.kwargs)
+            self.state = DONE
+        except:
+            self.error = str(sys.exc_info()[1])
+            self.state = FAILED
+        self.lock.acquire()
+        try:
+            self.finished.set()
+            listeners = self.listeners
+            self.listeners = []
+        finally:
+            self.lock.release()
+        for listener in listeners:
+            try:
+                listener(self)
+            except:
+                pass
+
+    def addListener(self, listener):
+        """Calls listener with the job once it has finished.
+
+        The listener is called right away if the job has already finished."""
+        self.lock.acquire()
+        try:
+            if not self.finished.isSet():
+                self.listeners.append(listener)
+                return
+        finally:
+            self.lock.release()
+        listener(self)
+
+    def wait(self, timeout=None):
+        """Blocks until the job has finished or the timeout has expired."""
+        self.finished.wait(timeout)
+        return self.state in (DONE, FAILED)
+
+    def status(self):
+        """Returns a JSON serializable description of the job state."""
+        status = {"state": self.state}
+        if self.error is not None:
+            status["error"] = self.error
+        return status
+
+class JobQueue(object):
+    """A FIFO queue of jobs served by a fixed pool of worker threads."""
+
+    def __init__(self, workers=2):
+        self.queue = Queue.Queue()
+        self.workers = []
+        for i in range(workers):
+            worker = threading.Thread(target=self.work)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, function, *args, **kwargs):
+        """Schedules function to be called with the given arguments.
+
+        Returns the Job, which can be used to follow the state of the work."""
+        job = Job(function, args, kwargs)
+        self.queue.put(job)
+        return job
+
+    def pending(self):
+        """Returns the (approximate) number of jobs waiting for a worker."""
+        return self.queue.qsize()
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            job.run()
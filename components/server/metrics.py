@@ -0,0 +1,220 @@
+"""Module contains the instrumentation of the Decapod server.
+
+Stages of the capture and export pipelines record their latency in histograms
+and their failures in counters; queues and caches publish their depth and hit
+counts through gauges read when the metrics are collected. Everything is kept
+in a Registry and rendered in the Prometheus text format on /metrics.
+"""
+
+import functools
+import threading
+import time
+
+import cherrypy
+
+defaultBuckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+def formatLabels(pairs):
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(['%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+                              for name, value in pairs])
+
+def formatValue(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+class Counter(object):
+    """A value which only goes up.
+
+    Its name is the name of its family, which ends in _total like those of
+    the gauges of kind "counter"."""
+
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        self.lock.acquire()
+        try:
+            self.value += amount
+        finally:
+            self.lock.release()
+
+    def samples(self, name, labels):
+        return [(name, labels, self.value)]
+
+class Histogram(object):
+    """Counts observed values in cumulative buckets, Prometheus style."""
+
+    def __init__(self, buckets=defaultBuckets):
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        self.lock.acquire()
+        try:
+            self.sum += value
+            self.count += 1
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[i] += 1
+                    break
+        finally:
+            self.lock.release()
+
+    def samples(self, name, labels):
+        self.lock.acquire()
+        try:
+            samples = []
+            cumulative = 0
+            for bound, count in zip(self.buckets, self.counts):
+                cumulative += count
+                samples.append((name + "_bucket", labels + (("le", formatValue(bound)),), cumulative))
+            samples.append((name + "_sum", labels, self.sum))
+            samples.append((name + "_count", labels, self.count))
+            return samples
+        finally:
+            self.lock.release()
+
+class Gauge(object):
+    """A value read from a function whenever the metrics are collected.
+
+    The function returns either a number or a dict of numbers by label value,
+    in which case label names the label."""
+
+    def __init__(self, function, label=None):
+        self.function = function
+        self.label = label
+
+    def samples(self, name, labels):
+        value = self.function()
+        if isinstance(value, dict):
+            return [(name, labels + ((self.label, key),), value[key]) for key in sorted(value)]
+        return [(name, labels, value)]
+
+class Registry(object):
+    """Holds every metric of the server, by name and labels."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}
+
+    def metric(self, kind, name, help, labels, factory):
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            if not name in self.families:
+                self.families[name] = (kind, help, {})
+            children = self.families[name][2]
+            if not labels in children:
+                children[labels] = factory()
+            return children[labels]
+        finally:
+            self.lock.release()
+
+    def counter(self, name, help="", **labels):
+        return self.metric("counter", name, help, labels, Counter)
+
+    def histogram(self, name, help="", buckets=defaultBuckets, **labels):
+        return self.metric("histogram", name, help, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name, function, help="", label=None, kind="gauge", **labels):
+        """Registers (or replaces) a metric read from function on collection.
+
+        kind may be "counter" for functions returning totals."""
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            if not name in self.families:
+                self.families[name] = (kind, help, {})
+            self.families[name][2][labels] = Gauge(function, label)
+        finally:
+            self.lock.release()
+
+    def remove(self, name, **labels):
+        """Forgets the metric with the given name and labels, if there is one."""
+        labels = tuple(sorted(labels.items()))
+        self.lock.acquire()
+        try:
+            if name in self.families:
+                self.families[name][2].pop(labels, None)
+        finally:
+            self.lock.release()
+
+    def time(self, name, help="", **labels):
+        """Returns a Timer observing into the named histogram."""
+        return Timer(self.histogram(name, help, **labels),
+                     self.counter(name.replace("_seconds", "") + "_failures_total", "Failed calls timed by %s" % name, **labels))
+
+    def render(self):
+        """Returns all of the metrics in the Prometheus text format."""
+        self.lock.acquire()
+        try:
+            families = sorted(self.families.items())
+        finally:
+            self.lock.release()
+
+        lines = []
+        for name, (kind, help, children) in families:
+            if help:
+                lines.append("# HELP %s %s" % (name, help))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, metric in sorted(children.items()):
+                try:
+                    samples = metric.samples(name, labels)
+                except Exception:
+                    # A broken gauge must not hide the other metrics.
+                    continue
+                for sampleName, sampleLabels, value in samples:
+                    lines.append("%s%s %s" % (sampleName, formatLabels(sampleLabels), formatValue(value)))
+        return "\n".join(lines) + "\n"
+
+class Timer(object):
+    """Measures a block of code or a function, counting failures separately.
+
+    Used as a context manager (with registry.time(...):) or, through timed(),
+    as a decorator."""
+
+    def __init__(self, histogram, failures):
+        self.histogram = histogram
+        self.failures = failures
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.histogram.observe(time.time() - self.start)
+        if type is not None:
+            self.failures.inc()
+        return False
+
+registry = Registry()
+
+def timed(name, help="", **labels):
+    """Decorates a function so every call is timed into the named histogram."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with registry.time(name, help, **labels):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+def recordRequestTiming(header=False):
+    """CherryPy tool recording the time spent handling each request.
+
+    With header=True the time is also sent to the client in an
+    X-Response-Time header (in milliseconds)."""
+    elapsed = time.time() - cherrypy.serving.response.time
+    registry.histogram("decapod_http_request_seconds", "Time spent handling HTTP requests",
+                       method=cherrypy.serving.request.method).observe(elapsed)
+    if header:
+        cherrypy.serving.response.headers["X-Response-Time"] = "%.1fms" % (elapsed * 1000)
+
+cherrypy.tools.timing = cherrypy.Tool("before_finalize", recordRequestTiming)
@@ -0,0 +1,145 @@
+"""Module contains a streaming PDF writer for the Decapod server.
+
+The writer turns a list of page images into a PDF with one image per page. It
+produces the document as a sequence of chunks, one page after the other, so it
+can be written to a file or sent in an HTTP response while later pages are
+still being read; only the offsets of the objects already written are kept in
+memory. JPEG pages (what the cameras capture) are embedded as they are, with
+the DCTDecode filter; other images are encoded to JPEG first, one at a time.
+"""
+
+import os
+from cStringIO import StringIO
+
+from PIL import Image
+
+class PdfError(Exception):
+    """Raised when a page can not be added to a PDF."""
+    pass
+
+colorSpaces = {"L": "/DeviceGray", "RGB": "/DeviceRGB", "CMYK": "/DeviceCMYK"}
+
+class PdfWriter(object):
+    """Writes page images to a PDF, one page at a time.
+
+    Pages get a size of their pixel size at resolution dots per inch. quality
+    is the JPEG quality used for the pages which are not JPEG files already."""
+
+    def __init__(self, resolution=300, quality=90, chunkSize=1 << 16):
+        self.resolution = resolution
+        self.quality = quality
+        self.chunkSize = chunkSize
+
+    def chunks(self, paths, progress=None):
+        """Yields the PDF of the images at paths, in pieces.
+
+        progress, if given, is called with the path of each page once it has
+        been written."""
+
+        # Objects 1 and 2 are the catalogue and the page tree; the page tree
+        # lists every page, so it is the last object written.
+        self.offset = 0
+        offsets = {}
+        pageIds = []
+
+        yield self.emit("%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+        offsets[1] = self.offset
+        yield self.emit("1 0 obj\n<< /Type /Catalog /Pages 2 0 R >>\nendobj\n")
+
+        nextId = 3
+        for path in paths:
+            imageId, contentId, pageId = nextId, nextId + 1, nextId + 2
+            nextId += 3
+            image, width, height = self.pageImage(imageId, path)
+
+            offsets[imageId] = self.offset
+            for chunk in image:
+                yield self.emit(chunk)
+
+            pageWidth = width * 72.0 / self.resolution
+            pageHeight = height * 72.0 / self.resolution
+            content = "q %.2f 0 0 %.2f 0 0 cm /Im0 Do Q" % (pageWidth, pageHeight)
+            offsets[contentId] = self.offset
+            yield self.emit("%d 0 obj\n<< /Length %d >>\nstream\n%s\nendstream\nendobj\n" % (contentId, len(content), content))
+
+            offsets[pageId] = self.offset
+            yield self.emit("%d 0 obj\n<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] "
+                            "/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>\nendobj\n"
+                            % (pageId, pageWidth, pageHeight, imageId, contentId))
+            pageIds.append(pageId)
+            if progress:
+                progress(path)
+
+        offsets[2] = self.offset
+        kids = " ".join(["%d 0 R" % id for id in pageIds])
+        yield self.emit("2 0 obj\n<< /Type /Pages /Kids [%s] /Count %d >>\nendobj\n" % (kids, len(pageIds)))
+
+        xref = self.offset
+        lines = ["xref\n0 %d\n0000000000 65535 f \n" % nextId]
+        for id in range(1, nextId):
+            lines.append("%010d 00000 n \n" % offsets[id])
+        lines.append("trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (nextId, xref))
+        yield self.emit("".join(lines))
+
+    def write(self, paths, filename, progress=None):
+        """Writes the PDF of the images at paths to a file.
+
+        The PDF is written next to filename and renamed once it is complete, so
+        a partial file is never mistaken for a finished one."""
+        partial = filename + ".part"
+        file = open(partial, "wb")
+        try:
+            for chunk in self.chunks(paths, progress):
+                file.write(chunk)
+        finally:
+            file.close()
+        os.rename(partial, filename)
+        return filename
+
+    def emit(self, data):
+        self.offset += len(data)
+        return data
+
+    def pageImage(self, id, path):
+        """Returns the chunks of the image object of a page, and its size."""
+        try:
+            image = Image.open(path)
+        except IOError:
+            raise PdfError("Could not read %s." % path)
+        width, height = image.size
+
+        if image.format == "JPEG" and image.mode in colorSpaces:
+            decode = ""
+            if image.mode == "CMYK" and "adobe" in image.info:
+                # Adobe applications write inverted CMYK JPEGs.
+                decode = " /Decode [1 0 1 0 1 0 1 0]"
+            length = os.path.getsize(path)
+            data = self.fileChunks(path)
+            mode = image.mode
+        else:
+            mode = image.mode == "L" and "L" or "RGB"
+            output = StringIO()
+            try:
+                image.convert(mode).save(output, "JPEG", quality=self.quality)
+            except IOError:
+                raise PdfError("Could not encode %s." % path)
+            decode = ""
+            data = [output.getvalue()]
+            length = len(data[0])
+
+        return (self.imageObject(id, width, height, mode, decode, length, data), width, height)
+
+    def imageObject(self, id, width, height, mode, decode, length, data):
+        yield ("%d 0 obj\n<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s /BitsPerComponent 8%s "
+               "/Filter /DCTDecode /Length %d >>\nstream\n" % (id, width, height, colorSpaces[mode], decode, length))
+        for chunk in data:
+            yield chunk
+        yield "\nendstream\nendobj\n"
+
+    def fileChunks(self, path):
+        file = open(path, "rb")
+        try:
+            for chunk in iter(lambda: file.read(self.chunkSize), ""):
+                yield chunk
+        finally:
+            file.close()
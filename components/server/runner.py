@@ -0,0 +1,179 @@
+"""Module contains the command runner shared by the Decapod server.
+
+All external tools (gphoto2, ImageMagick, the decapod tools) are started
+through a CommandRunner: without a shell, with an argument list, with a timeout
+and with a bound on the number of copies of each tool running at the same time.
+Their output is captured and the runner keeps timing statistics per tool.
+"""
+
+import multiprocessing
+import os
+import subprocess
+import threading
+import time
+
+# Seconds a tool may run before it is killed, by tool name.
+timeouts = {
+    "gphoto2": 60,
+    "decapod-stitching": 300,
+    "convert": 300,
+    "mogrify": 300,
+    "tiffcp": 1800,
+    "decapod-genpdf.py": 3600,
+}
+defaultTimeout = 600
+
+# Copies of a tool allowed to run at the same time, by tool name.
+limits = {
+    "gphoto2": 8, # each camera only captures once at a time, see cameras.Gphoto2Backend
+    "convert": multiprocessing.cpu_count(),
+    "mogrify": multiprocessing.cpu_count(),
+}
+defaultLimit = 2
+
+class CommandError(Exception):
+    """Raised when a command could not be run or exited with an error."""
+
+    def __init__(self, message, result=None):
+        Exception.__init__(self, message)
+        self.result = result
+
+class CommandTimeout(CommandError):
+    """Raised when a command was killed because it ran for too long."""
+    pass
+
+class Result(object):
+    """The outcome of a command: exit status, captured output and run time."""
+
+    def __init__(self, args, status, stdout, stderr, seconds, timedOut=False):
+        self.args = args
+        self.status = status
+        self.stdout = stdout
+        self.stderr = stderr
+        self.seconds = seconds
+        self.timedOut = timedOut
+
+class ToolStats(object):
+    """Timing and failure counters of one tool."""
+
+    def __init__(self):
+        self.calls = 0
+        self.failures = 0
+        self.timeouts = 0
+        self.running = 0
+        self.waiting = 0
+        self.seconds = 0.0
+        self.maxSeconds = 0.0
+
+    def asDict(self):
+        return {"calls": self.calls, "failures": self.failures, "timeouts": self.timeouts,
+                "running": self.running, "waiting": self.waiting,
+                "seconds": self.seconds, "maxSeconds": self.maxSeconds}
+
+class CommandRunner(object):
+    """Runs external commands with timeouts and per-tool concurrency limits."""
+
+    def __init__(self, timeouts=timeouts, limits=limits):
+        self.timeouts = dict(timeouts)
+        self.limits = dict(limits)
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.stats = {}
+
+    def tool(self, args):
+        return os.path.basename(args[0])
+
+    def semaphore(self, tool):
+        self.lock.acquire()
+        try:
+            if not tool in self.semaphores:
+                self.semaphores[tool] = threading.Semaphore(self.limits.get(tool, defaultLimit))
+                self.stats[tool] = ToolStats()
+            return self.semaphores[tool], self.stats[tool]
+        finally:
+            self.lock.release()
+
+    def run(self, args, timeout=None, check=True, cwd=None, env=None):
+        """Runs a command given as a list of arguments and returns its Result.
+
+        Waits for a free slot if too many copies of the tool are running. The
+        command is killed after timeout seconds (by default the timeout of the
+        tool). If check is true, CommandError (or CommandTimeout) is raised
+        unless the command exits with status 0."""
+
+        args = [str(arg) for arg in args]
+        tool = self.tool(args)
+        if timeout is None:
+            timeout = self.timeouts.get(tool, defaultTimeout)
+        semaphore, stats = self.semaphore(tool)
+
+        self.count(stats, "waiting", 1)
+        semaphore.acquire()
+        self.count(stats, "waiting", -1)
+        self.count(stats, "running", 1)
+        start = time.time()
+        try:
+            try:
+                process = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                           cwd=cwd, env=env, close_fds=True)
+            except OSError as e:
+                result = Result(args, -1, "", str(e), time.time() - start)
+            else:
+                timedOut = []
+                def kill():
+                    timedOut.append(True)
+                    try:
+                        process.kill()
+                    except OSError:
+                        pass
+                timer = threading.Timer(timeout, kill)
+                timer.start()
+                try:
+                    stdout, stderr = process.communicate()
+                finally:
+                    timer.cancel()
+                result = Result(args, process.returncode, stdout, stderr, time.time() - start, bool(timedOut))
+        finally:
+            self.count(stats, "running", -1)
+            semaphore.release()
+
+        self.record(stats, result)
+        if check and result.timedOut:
+            raise CommandTimeout("%s timed out after %s seconds." % (tool, timeout), result)
+        if check and result.status != 0:
+            raise CommandError("%s failed with status %d: %s" % (tool, result.status, result.stderr.strip()[-500:]), result)
+        return result
+
+    def count(self, stats, counter, change):
+        self.lock.acquire()
+        try:
+            setattr(stats, counter, getattr(stats, counter) + change)
+        finally:
+            self.lock.release()
+
+    def record(self, stats, result):
+        self.lock.acquire()
+        try:
+            stats.calls += 1
+            stats.seconds += result.seconds
+            stats.maxSeconds = max(stats.maxSeconds, result.seconds)
+            if result.status != 0:
+                stats.failures += 1
+            if result.timedOut:
+                stats.timeouts += 1
+        finally:
+            self.lock.release()
+
+    def statistics(self):
+        """Returns the counters of every tool run so far, by tool name."""
+        self.lock.acquire()
+        try:
+            return dict([(tool, stats.asDict()) for tool, stats in self.stats.items()])
+        finally:
+            self.lock.release()
+
+defaultRunner = CommandRunner()
+
+def run(args, timeout=None, check=True, cwd=None, env=None):
+    """Runs a command with the shared runner, see CommandRunner.run."""
+    return defaultRunner.run(args, timeout, check, cwd, env)
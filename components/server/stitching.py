@@ -0,0 +1,91 @@
+"""Module contains the stitching backends of the Decapod server.
+
+Stitching composes the left and right captures of a spread into one image. It
+can be done by the decapod-stitching tool, in a separate process, or in-process
+with PIL (and NumPy, when it is installed), writing the spread in a format that
+is cheaper to encode than a full-size PNG.
+"""
+
+from PIL import Image
+
+import runner
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class StitchingError(Exception):
+    """Raised when a spread could not be stitched."""
+    pass
+
+class SubprocessStitcher(object):
+    """Stitches spreads by running the decapod-stitching tool."""
+
+    extension = "png"
+
+    def __init__(self, options=""):
+        self.options = options
+
+    def stitch(self, image_one, image_two, output):
+        #Image Magick implementation
+        #runner.run(["convert", image_one, image_two, "+append", output])
+
+        #Decapod implementation
+        try:
+            runner.run(["decapod-stitching"] + self.options.split() + [image_one, image_two, "-o", output])
+        except runner.CommandError as e:
+            raise StitchingError("Could not stitch %s and %s: %s" % (image_one, image_two, e))
+        return output
+
+class ImageStitcher(object):
+    """Stitches spreads in-process, placing the two pages side by side.
+
+    format is one of "jpeg", "webp" or "png". quality applies to JPEG and
+    WebP, compressLevel (0-9, lower is faster) to PNG."""
+
+    saveOptions = {"jpeg": "JPEG", "webp": "WEBP", "png": "PNG"}
+
+    def __init__(self, format="jpeg", quality=90, compressLevel=1, background=(255, 255, 255)):
+        if not format in self.saveOptions:
+            raise ValueError("Unsupported stitching format %s" % format)
+        self.format = format
+        self.extension = format == "jpeg" and "jpg" or format
+        self.quality = quality
+        self.compressLevel = compressLevel
+        self.background = background
+
+    def compose(self, left, right):
+        """Returns a new image with left and right next to each other."""
+        width = left.size[0] + right.size[0]
+        height = max(left.size[1], right.size[1])
+
+        if numpy is not None and left.size[1] == right.size[1]:
+            return Image.fromarray(numpy.hstack((numpy.asarray(left), numpy.asarray(right))))
+
+        spread = Image.new("RGB", (width, height), self.background)
+        spread.paste(left, (0, (height - left.size[1]) // 2))
+        spread.paste(right, (left.size[0], (height - right.size[1]) // 2))
+        return spread
+
+    def stitch(self, image_one, image_two, output):
+        try:
+            left = Image.open(image_one).convert("RGB")
+            right = Image.open(image_two).convert("RGB")
+        except IOError:
+            raise StitchingError("Could not read %s and %s." % (image_one, image_two))
+
+        spread = self.compose(left, right)
+        if self.format == "png":
+            spread.save(output, "PNG", compress_level=self.compressLevel)
+        else:
+            spread.save(output, self.saveOptions[self.format], quality=self.quality)
+        return output
+
+def createStitcher(backend, **options):
+    """Returns the stitcher for a backend name: "decapod" or "pil"."""
+    if backend == "decapod":
+        return SubprocessStitcher(**options)
+    elif backend == "pil":
+        return ImageStitcher(**options)
+    raise ValueError("Unknown stitching backend %s" % backend)
@@ -0,0 +1,303 @@
+"""Module contains the image storage of the Decapod server.
+
+Captured images are stored by their content: a file is named after the SHA-1
+digest of its bytes, so capturing (or importing) the same image twice stores it
+once. Spreads and thumbnails are named after the images they are made from,
+which lets the server know their paths before they are generated and stitch
+identical captures only once. Files are spread over two levels of
+subdirectories named after the first characters of their digest, which keeps
+directories small with tens of thousands of files.
+
+A file may be used by several entries of the catalogue, so it is only removed
+once no entry refers to it any more. A retention policy can make old books
+smaller: drop the raw halves of spreads which have been stitched and verified,
+and recompress old pages to JPEG.
+"""
+
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+
+from PIL import Image
+
+partialPrefix = ".part-"
+
+class StorageError(Exception):
+    """Raised when a file can not be added to the store."""
+    pass
+
+def fileDigest(path, chunkSize=1 << 16):
+    """Returns the SHA-1 digest of the contents of a file, in hex."""
+    digest = hashlib.sha1()
+    file = open(path, "rb")
+    try:
+        for chunk in iter(lambda: file.read(chunkSize), ""):
+            digest.update(chunk)
+    finally:
+        file.close()
+    return digest.hexdigest()
+
+class ContentStore(object):
+    """Content-addressed files under the directory at path.
+
+    A file with digest "3f2a9c..." is kept as path/3f/2a/3f2a9c....jpg; depth
+    is the number of directory levels, width the number of characters of the
+    digest naming each of them."""
+
+    def __init__(self, path, depth=2, width=2):
+        self.path = path
+        self.depth = depth
+        self.width = width
+        self.lock = threading.Lock()
+
+    def pathFor(self, digest, suffix):
+        """Returns the path of the file with a digest, creating its directory."""
+        parts = [digest[i * self.width:(i + 1) * self.width] for i in range(self.depth)]
+        directory = os.path.join(self.path, *parts)
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # Created by another thread in the meantime.
+                if not os.path.isdir(directory):
+                    raise
+        return os.path.join(directory, digest + suffix)
+
+    def put(self, source, suffix=None):
+        """Moves a file into the store and returns its new path.
+
+        If the store already holds a file with the same contents, source is
+        removed and the path of that file is returned."""
+        if suffix is None:
+            suffix = os.path.splitext(source)[1].lower()
+        try:
+            path = self.pathFor(fileDigest(source), suffix)
+            self.lock.acquire()
+            try:
+                if os.path.exists(path):
+                    os.unlink(source)
+                else:
+                    shutil.move(source, path)
+            finally:
+                self.lock.release()
+        except (IOError, OSError) as e:
+            raise StorageError("Could not store %s: %s" % (source, e))
+        return path
+
+    def derivedPath(self, sources, suffix):
+        """Returns the path of a file generated from the files at sources.
+
+        The name only depends on the names of the sources, which are their
+        digests for the files of the store."""
+        names = " ".join([os.path.basename(source) for source in sources])
+        return self.pathFor(hashlib.sha1(names).hexdigest(), suffix)
+
+    def partialPath(self, path):
+        """Returns a temporary path to write the file at path to.
+
+        Renaming the temporary file once it is complete means a partial file is
+        never found at path. The extension is kept for the tools which read the
+        format from it."""
+        directory, name = os.path.split(path)
+        return os.path.join(directory, "%s%s-%s" % (partialPrefix, uuid.uuid4().hex[:8], name))
+
+    def temporaryPath(self, suffix):
+        """Returns a new temporary path in the store, for a file to put()."""
+        return os.path.join(self.path, "%s%s%s" % (partialPrefix, uuid.uuid4().hex, suffix))
+
+    def contains(self, path):
+        """Tells whether a path is in the directory of the store."""
+        root = os.path.join(os.path.abspath(self.path), "")
+        return os.path.abspath(path).startswith(root)
+
+    def release(self, paths, references):
+        """Removes the files at paths which are not in references.
+
+        Only files of the store are removed, never files elsewhere which
+        entries of the catalogue may point to. Returns the number of bytes
+        freed."""
+        freed = 0
+        for path in set(paths):
+            if not path or path in references or not self.contains(path):
+                continue
+            try:
+                size = os.path.getsize(path)
+                os.unlink(path)
+                freed += size
+            except OSError:
+                pass
+        return freed
+
+    def isShard(self, name):
+        return len(name) == self.width and name.strip("0123456789abcdef") == ""
+
+    def files(self):
+        """Yields the path, size and modification time of every stored file.
+
+        Other files in the directory of the store (such as images captured
+        before the store existed) are left out, except temporary ones."""
+        for directory, names, files in os.walk(self.path):
+            if directory == self.path:
+                names[:] = [name for name in names if self.isShard(name)]
+                files = [name for name in files if name.startswith(partialPrefix)]
+            for name in files:
+                path = os.path.join(directory, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                yield path, info.st_size, info.st_mtime
+
+    def collect(self, references, grace=3600):
+        """Removes the stored files no entry refers to.
+
+        Files younger than grace seconds are kept, since they may belong to a
+        capture which is not in the catalogue yet. Returns the number of files
+        and of bytes removed."""
+        references = set([os.path.abspath(path) for path in references])
+        limit = time.time() - grace
+        files = 0
+        freed = 0
+        for path, size, mtime in list(self.files()):
+            if mtime > limit or os.path.abspath(path) in references:
+                continue
+            try:
+                os.unlink(path)
+                files += 1
+                freed += size
+            except OSError:
+                pass
+        return files, freed
+
+    def usage(self, entries, states):
+        """Returns a JSON serializable report of the disk space used.
+
+        entries are the entries of the catalogue; states are the names of their
+        fields holding paths. Reports the files and bytes used by each state,
+        how many bytes the deduplication saves, and the stored files which no
+        entry refers to."""
+        sizes = {}
+        for path, size, mtime in self.files():
+            sizes[os.path.abspath(path)] = size
+
+        report = {"states": {}, "logicalBytes": 0}
+        referenced = {}
+        for state in states:
+            counted = {}
+            for entry in entries:
+                path = entry.get(state)
+                if not path:
+                    continue
+                size = sizes.get(os.path.abspath(path))
+                if size is None:
+                    # Files outside the store (or missing ones).
+                    try:
+                        size = os.path.getsize(path)
+                    except OSError:
+                        continue
+                report["logicalBytes"] += size
+                counted[path] = size
+                referenced[os.path.abspath(path)] = size
+            report["states"][state] = {"files": len(counted), "bytes": sum(counted.values())}
+
+        referencedBytes = sum(referenced.values())
+        unreferenced = [size for path, size in sizes.items() if not path in referenced]
+        report["referencedBytes"] = referencedBytes
+        report["deduplicatedBytes"] = report["logicalBytes"] - referencedBytes
+        report["unreferenced"] = {"files": len(unreferenced), "bytes": sum(unreferenced)}
+        report["files"] = len(sizes)
+        report["bytes"] = sum(sizes.values())
+        try:
+            info = os.statvfs(self.path)
+            report["filesystem"] = {"free": info.f_bavail * info.f_frsize, "size": info.f_blocks * info.f_frsize}
+        except (AttributeError, OSError):
+            pass
+        return report
+
+class RetentionPolicy(object):
+    """Decides what is kept of the spreads of a book as they get older.
+
+    dropRawAfter is the age in seconds after which the left and right images
+    of a spread are dropped, once its stitched image has been verified (0 drops
+    them as soon as possible); recompressAfter the age after which the page
+    images are recompressed to JPEG at quality. None keeps them as they are.
+    The age of a spread is the age of its stitched image. sweepInterval is the
+    time between two applications of the policy, grace the age under which
+    stored files no entry refers to are kept."""
+
+    def __init__(self, dropRawAfter=None, recompressAfter=None, quality=75, sweepInterval=3600, grace=3600):
+        self.dropRawAfter = dropRawAfter
+        self.recompressAfter = recompressAfter
+        self.quality = quality
+        self.sweepInterval = sweepInterval
+        self.grace = grace
+
+    def describe(self):
+        return {"dropRawAfter": self.dropRawAfter, "recompressAfter": self.recompressAfter,
+                "quality": self.quality, "sweepInterval": self.sweepInterval, "grace": self.grace}
+
+    def apply(self, entry, store, now=None):
+        """Returns the entry as the policy wants it, or None to leave it as is.
+
+        Recompressed images are added to the store; the images the entry no
+        longer refers to are left for the caller to release."""
+        spread = entry.get("spread")
+        try:
+            age = (now or time.time()) - os.path.getmtime(spread)
+        except (OSError, TypeError):
+            # Not stitched (yet).
+            return None
+
+        changed = dict(entry)
+        if self.dropRawAfter is not None and age >= self.dropRawAfter and "left" in entry and self.verify(entry):
+            del changed["left"]
+            del changed["right"]
+        if self.recompressAfter is not None and age >= self.recompressAfter and not "quality" in entry:
+            for state in ("left", "right", "spread"):
+                if state in changed:
+                    changed[state] = self.recompress(changed[state], store)
+            changed["quality"] = self.quality
+
+        if changed == entry:
+            return None
+        return changed
+
+    def verify(self, entry):
+        """Tells whether the stitched image of a spread is complete.
+
+        It must decode and hold both halves: be at least as wide as the two of
+        them side by side, and as tall as the taller one. A spread holding a
+        single page is not enough to drop the halves for."""
+        try:
+            spread = Image.open(entry["spread"])
+            spread.verify()
+            width, height = spread.size
+            left = Image.open(entry["left"]).size
+            right = Image.open(entry["right"]).size
+        except Exception:
+            return False
+        return width >= left[0] + right[0] and height >= max(left[1], right[1])
+
+    def recompress(self, path, store):
+        """Returns the path of a JPEG of the image at path, at quality.
+
+        Keeps the image as it is if the JPEG would not be smaller."""
+        output = store.temporaryPath(".jpg")
+        try:
+            image = Image.open(path)
+            mode = image.mode == "L" and "L" or "RGB"
+            image.convert(mode).save(output, "JPEG", quality=self.quality)
+        except (IOError, OSError):
+            if os.path.exists(output):
+                os.unlink(output)
+            return path
+        if os.path.getsize(output) >= os.path.getsize(path):
+            os.unlink(output)
+            return path
+        try:
+            return store.put(output, ".jpg")
+        except StorageError:
+            return path
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+"""A stand-in for the decapod-genpdf.py tool, for testing purposes.
+
+Sleeps for FAKE_GENPDF_DELAY seconds (default 0) and writes an empty PDF to
+the path given with -p.
+
+    decapod-genpdf.py -d workdir -p output.pdf -b book.tiff [-v level]
+"""
+
+import os
+import sys
+import time
+
+emptyPdf = """%PDF-1.4
+1 0 obj << /Type /Catalog /Pages 2 0 R >> endobj
+2 0 obj << /Type /Pages /Kids [] /Count 0 >> endobj
+trailer << /Root 1 0 R >>
+%%EOF
+"""
+
+def main(args):
+    time.sleep(float(os.environ.get("FAKE_GENPDF_DELAY", "0")))
+    if not "-p" in args:
+        sys.stderr.write("usage: decapod-genpdf.py -d workdir -p output.pdf -b book.tiff\n")
+        return 1
+    out = open(args[args.index("-p") + 1], "w")
+    try:
+        out.write(emptyPdf)
+    finally:
+        out.close()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
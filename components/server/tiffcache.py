@@ -0,0 +1,182 @@
+"""Module contains a content-addressed cache of converted page images.
+
+Exporting a book converts every page to TIFF. Pages rarely change between two
+exports, so the converted files are kept in a cache directory, named after the
+hash of the source file and of the conversion parameters. Cache misses are
+converted in parallel, using all of the cores of the machine, and the least
+recently used files are evicted once the cache grows past its maximum size.
+"""
+
+import hashlib
+import multiprocessing
+import os
+import sys
+import threading
+import Queue
+
+import runner
+
+class ConversionError(Exception):
+    """Raised when a page could not be converted."""
+    pass
+
+class TiffCache(object):
+    """A size-bounded cache of converted (by default TIFF) page images."""
+
+    def __init__(self, cachePath, maxSize, format="tiff", parameters="", workers=None):
+        self.cachePath = cachePath
+        self.maxSize = maxSize
+        self.format = format
+        self.parameters = parameters
+        self.workers = workers or multiprocessing.cpu_count()
+        self.digests = {}
+        self.inUse = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if not os.path.exists(cachePath):
+            os.makedirs(cachePath)
+
+    def digest(self, source):
+        """Returns the SHA-1 of a source file.
+
+        Digests are remembered for as long as the file keeps its size and
+        modification time, so unchanged pages are not read again."""
+        info = os.stat(source)
+        fileKey = (os.path.abspath(source), info.st_size, info.st_mtime)
+        digest = self.digests.get(fileKey)
+        if digest is None:
+            sha = hashlib.sha1()
+            file = open(source, "rb")
+            try:
+                for chunk in iter(lambda: file.read(1 << 16), ""):
+                    sha.update(chunk)
+            finally:
+                file.close()
+            digest = sha.hexdigest()
+            self.digests[fileKey] = digest
+        return digest
+
+    def path(self, source):
+        """Returns the cache path of the converted version of source."""
+        key = hashlib.sha1("%s %s %s" % (self.digest(source), self.format, self.parameters)).hexdigest()
+        return os.path.join(self.cachePath, "%s.%s" % (key, self.format))
+
+    def convert(self, sources, progress=None):
+        """Returns the converted versions of sources, in the same order.
+
+        Files missing from the cache are converted in parallel. The returned
+        files will not be evicted until they are passed to release(). If given,
+        progress is called once for every source that is ready."""
+
+        paths = [self.path(source) for source in sources]
+        self.acquire(paths)
+
+        misses = Queue.Queue()
+        queued = {}
+        duplicates = []
+        for source, path in zip(sources, paths):
+            if os.path.exists(path):
+                self.hits += 1
+                os.utime(path, None)
+                if progress:
+                    progress(source)
+            elif path in queued:
+                duplicates.append(source)
+            else:
+                self.misses += 1
+                queued[path] = source
+                misses.put((source, path))
+
+        errors = []
+        def work():
+            while True:
+                try:
+                    source, path = misses.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    self.convertOne(source, path)
+                except:
+                    errors.append(sys.exc_info()[1])
+                if progress:
+                    progress(source)
+
+        threads = []
+        for i in range(min(self.workers, len(queued))):
+            thread = threading.Thread(target=work)
+            thread.setDaemon(True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if errors:
+            self.release(paths)
+            raise errors[0]
+        if progress:
+            for source in duplicates:
+                progress(source)
+
+        self.evict()
+        return paths
+
+    def convertOne(self, source, path):
+        # Convert to a temporary name first, so a half-written file is never
+        # taken for a cache hit.
+        temporaryPath = "%s.%d.tmp" % (path, threading.currentThread().ident or 0)
+        command = ["convert", source] + self.parameters.split() + ["%s:%s" % (self.format, temporaryPath)]
+        try:
+            runner.run(command)
+        except runner.CommandError as e:
+            if os.path.exists(temporaryPath):
+                os.unlink(temporaryPath)
+            raise ConversionError("Could not convert %s to %s: %s" % (source, self.format, e))
+        os.rename(temporaryPath, path)
+
+    def acquire(self, paths):
+        self.lock.acquire()
+        try:
+            for path in paths:
+                self.inUse[path] = self.inUse.get(path, 0) + 1
+        finally:
+            self.lock.release()
+
+    def release(self, paths):
+        """Allows files returned by convert() to be evicted again."""
+        self.lock.acquire()
+        try:
+            for path in paths:
+                count = self.inUse.get(path, 0) - 1
+                if count > 0:
+                    self.inUse[path] = count
+                else:
+                    self.inUse.pop(path, None)
+        finally:
+            self.lock.release()
+
+    def evict(self):
+        """Removes the least recently used files until the cache fits maxSize.
+
+        Files in use by a running export are never removed."""
+        self.lock.acquire()
+        try:
+            files = []
+            total = 0
+            for name in os.listdir(self.cachePath):
+                path = os.path.join(self.cachePath, name)
+                if name.endswith(".tmp"):
+                    continue
+                info = os.stat(path)
+                files.append((info.st_mtime, info.st_size, path))
+                total += info.st_size
+            files.sort()
+            for mtime, size, path in files:
+                if total <= self.maxSize:
+                    break
+                if path in self.inUse:
+                    continue
+                os.unlink(path)
+                total -= size
+        finally:
+            self.lock.release()
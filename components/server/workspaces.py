@@ -0,0 +1,170 @@
+"""Module contains the book workspaces of the Decapod server.
+
+Every book being scanned lives in its own workspace: a directory holding its
+captured images, its catalogue and its exports, with its own image numbering
+and its own event stream. A server can then be shared by several scanning
+stations, each working on its own book (and, optionally, its own cameras),
+without their captures, ids or files getting mixed up.
+"""
+
+import glob
+import os
+import re
+import shutil
+import threading
+import uuid
+
+import simplejson as json
+
+from catalogue import Catalogue
+from events import EventBus
+from storage import ContentStore
+
+# Names of books, as used in their URL and directory name.
+namePattern = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+class WorkspaceError(Exception):
+    """Raised when a workspace can not be created or found."""
+    pass
+
+def prepareDirectory(path):
+    """Creates a directory the server writes to, unless it already exists.
+
+    Done once when the server starts rather than on every request (FLUID-3537)."""
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if not os.access(path, os.W_OK):
+        raise IOError("Can not write to directory %s" % path)
+
+def lastImageIndex(imagePath):
+    """Returns the highest index used in the name of a pending capture.
+
+    Captures are downloaded to newDecapodCapture-<index>.jpg before they are
+    moved into the store (named after their contents). A capture interrupted
+    by a restart leaves its download behind, the only copy of that image, so
+    new captures must not reuse its name: gphoto2 would overwrite it."""
+    last = 0
+    for path in glob.glob("%s/newDecapodCapture-*.jpg" % imagePath):
+        name = os.path.basename(path)[len("newDecapodCapture-"):-len(".jpg")]
+        if name.isdigit():
+            last = max(last, int(name))
+    return last
+
+class Workspace(object):
+    """The files and the state of one book.
+
+    By default everything is kept in the directory at path; imagePath,
+    cataloguePath and exportPath can put parts of it elsewhere. ports, if
+    given, are the ports of the cameras used for this book."""
+
+    def __init__(self, name, path, imagePath=None, cataloguePath=None, exportPath=None, ports=None):
+        self.name = name
+        self.path = path
+        self.imagePath = imagePath or os.path.join(path, "capturedImages")
+        self.cataloguePath = cataloguePath or os.path.join(path, "catalogue.sqlite")
+        self.exportPath = exportPath or os.path.join(path, "pdf")
+        self.ports = ports
+        prepareDirectory(self.imagePath)
+        prepareDirectory(self.exportPath)
+
+        self.catalogue = Catalogue(self.cataloguePath)
+        self.store = ContentStore(self.imagePath)
+        self.events = EventBus()
+        self.indexLock = threading.Lock()
+        self.imageIndex = lastImageIndex(self.imagePath)
+
+    def nextImageIndex(self):
+        """Returns a new index for the name of a captured image."""
+        self.indexLock.acquire()
+        try:
+            self.imageIndex += 1
+            return self.imageIndex
+        finally:
+            self.indexLock.release()
+
+    def cameras(self, cameras):
+        """Returns the cameras of a list which are used for this book."""
+        if not self.ports:
+            return cameras
+        return [camera for camera in cameras if camera["port"] in self.ports]
+
+    def describe(self):
+        """Returns a JSON serializable description of the book."""
+        return {"name": self.name, "ports": self.ports, "images": len(self.catalogue),
+                "version": self.catalogue.version}
+
+    def close(self):
+        self.catalogue.close()
+
+class WorkspaceManager(object):
+    """Creates and keeps track of the workspaces of the books in a directory.
+
+    Each book is a subdirectory of path, named after the book, with its
+    settings in a book.json file. Workspaces are opened on first use."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.workspaces = {}
+        prepareDirectory(path)
+
+    def settingsPath(self, name):
+        return os.path.join(self.path, name, "book.json")
+
+    def names(self):
+        """Returns the names of all of the books, sorted."""
+        return sorted([name for name in os.listdir(self.path)
+                       if namePattern.match(name) and os.path.exists(self.settingsPath(name))])
+
+    def get(self, name):
+        """Returns the workspace of a book, or None if there is no such book."""
+        if not namePattern.match(name):
+            return None
+        self.lock.acquire()
+        try:
+            if not name in self.workspaces:
+                if not os.path.exists(self.settingsPath(name)):
+                    return None
+                file = open(self.settingsPath(name))
+                try:
+                    settings = json.load(file)
+                finally:
+                    file.close()
+                self.workspaces[name] = Workspace(name, os.path.join(self.path, name), ports=settings.get("ports"))
+            return self.workspaces[name]
+        finally:
+            self.lock.release()
+
+    def create(self, name=None, ports=None):
+        """Creates a new book and returns its workspace.
+
+        Without a name, the book gets a generated one."""
+        if name is None:
+            name = uuid.uuid4().hex[:12]
+        if not namePattern.match(name):
+            raise WorkspaceError("Book names are made of letters, digits, - and _.")
+        self.lock.acquire()
+        try:
+            if os.path.exists(self.settingsPath(name)):
+                raise WorkspaceError("There already is a book named %s." % name)
+            workspace = Workspace(name, os.path.join(self.path, name), ports=ports)
+            file = open(self.settingsPath(name), "w")
+            try:
+                json.dump({"ports": ports}, file)
+            finally:
+                file.close()
+            self.workspaces[name] = workspace
+            return workspace
+        finally:
+            self.lock.release()
+
+    def remove(self, name):
+        """Removes a book and all of its files."""
+        self.lock.acquire()
+        try:
+            workspace = self.workspaces.pop(name, None)
+            if workspace is not None:
+                workspace.close()
+            shutil.rmtree(os.path.join(self.path, name), True)
+        finally:
+            self.lock.release()
@@ -0,0 +1,68 @@
+"""Tests for the list of attached cameras of the gphoto2 backend (cameras.CameraRegistry).
+
+The cameras are those reported by the stand-in gphoto2 of
+components/server/testData/bin. Run the tests from the root of the repository
+with:
+
+    python -m unittest discover -s tests/server
+"""
+
+import os
+import sys
+import threading
+import unittest
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "server")
+sys.path.insert(0, serverPath)
+
+import cameras
+from cameras import CameraRegistry
+
+stubPath = os.path.join(serverPath, "testData", "bin")
+
+class CameraRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ["PATH"] = stubPath + os.pathsep + os.environ.get("PATH", "")
+        for name in ("FAKE_GPHOTO2_DELAY", "FAKE_GPHOTO2_CONNECT_DELAY", "FAKE_GPHOTO2_CAMERAS"):
+            os.environ.pop(name, None)
+        # Count the runs of gphoto2 by their first argument.
+        self.runs = {}
+        self.gphoto2 = cameras.gphoto2
+        def gphoto2(*args):
+            self.runs[args[0]] = self.runs.get(args[0], 0) + 1
+            return self.gphoto2(*args)
+        cameras.gphoto2 = gphoto2
+
+    def tearDown(self):
+        cameras.gphoto2 = self.gphoto2
+        os.environ.clear()
+        os.environ.update(self.environ)
+
+    def testFirstCallersShareOneProbe(self):
+        # Slow cameras keep the first probe running while the others arrive.
+        os.environ["FAKE_GPHOTO2_CONNECT_DELAY"] = "0.3"
+        registry = CameraRegistry()
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(registry.cameras())) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.runs, {"--auto-detect": 1, "--summary": 2})
+        self.assertEqual(len(results), 4)
+        for result in results:
+            self.assertEqual([camera["port"] for camera in result], ["usb:002,012", "usb:003,004"])
+
+    def testDisconnectedCameraIsForgotten(self):
+        registry = CameraRegistry()
+        self.assertEqual(len(registry.cameras()), 2)
+        os.environ["FAKE_GPHOTO2_CAMERAS"] = "Nikon D80@usb:003,004"
+        self.assertEqual([camera["port"] for camera in registry.refresh()], ["usb:003,004"])
+        self.assertEqual(list(registry.capabilities.keys()), [("Nikon D80", "usb:003,004")])
+        # The remaining camera is not asked for its summary again.
+        self.assertEqual(self.runs, {"--auto-detect": 2, "--summary": 2})
+
+if __name__ == "__main__":
+    unittest.main()
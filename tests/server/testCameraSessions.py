@@ -0,0 +1,111 @@
+"""Tests for the gphoto2 shell sessions of the camera backend (cameras.SessionManager).
+
+The sessions talk to the --shell mode of the stand-in gphoto2 of
+components/server/testData/bin, which can be made to exit after some captures
+as a camera does when it is unplugged. Run the tests from the root of the
+repository with:
+
+    python -m unittest discover -s tests/server
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "server")
+sys.path.insert(0, serverPath)
+
+from cameras import SessionError, SessionManager
+
+stubPath = os.path.join(serverPath, "testData", "bin")
+model, port = "Nikon D80", "usb:003,004"
+
+class SessionManagerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ["PATH"] = stubPath + os.pathsep + os.environ.get("PATH", "")
+        for name in ("FAKE_GPHOTO2_DELAY", "FAKE_GPHOTO2_CONNECT_DELAY", "FAKE_GPHOTO2_SHELL_FAILURES"):
+            os.environ.pop(name, None)
+        self.directory = tempfile.mkdtemp()
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.close()
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory, True)
+
+    def manager(self, **options):
+        options.setdefault("downloadPath", os.path.join(self.directory, "downloads"))
+        options.setdefault("healthInterval", 3600)
+        manager = SessionManager(**options)
+        self.managers.append(manager)
+        return manager
+
+    def capture(self, manager, name):
+        filename = os.path.join(self.directory, name)
+        manager.capture(port, model, filename)
+        self.assertTrue(os.path.getsize(filename) > 0)
+
+    def testSessionIsReused(self):
+        manager = self.manager()
+        self.capture(manager, "1.jpg")
+        process = manager.sessions[port].process
+        self.capture(manager, "2.jpg")
+        self.assertTrue(manager.sessions[port].process is process)
+        self.assertEqual(manager.counts(manager.captures), {port: 2})
+        self.assertEqual(manager.counts(manager.reconnects), {})
+
+    def testReconnectAndRetry(self):
+        # The shell exits after its second capture, before answering.
+        os.environ["FAKE_GPHOTO2_SHELL_FAILURES"] = "2"
+        manager = self.manager()
+        self.capture(manager, "1.jpg")
+        self.capture(manager, "2.jpg")
+        self.assertEqual(manager.counts(manager.reconnects), {port: 1})
+        self.assertEqual(manager.counts(manager.captures), {port: 2})
+        self.assertTrue(manager.sessions[port].alive())
+
+    def testFailureWithoutRetries(self):
+        os.environ["FAKE_GPHOTO2_SHELL_FAILURES"] = "1"
+        manager = self.manager(retries=0)
+        self.assertRaises(SessionError, manager.capture, port, model, os.path.join(self.directory, "1.jpg"))
+        # Nothing was reopened for the failed capture.
+        self.assertEqual(manager.counts(manager.reconnects), {})
+        # The next capture opens a new session.
+        os.environ.pop("FAKE_GPHOTO2_SHELL_FAILURES")
+        self.capture(manager, "2.jpg")
+
+    def testHealthCheckReopensDeadSession(self):
+        manager = self.manager()
+        self.capture(manager, "1.jpg")
+        session = manager.sessions[port]
+        session.process.kill()
+        session.process.wait()
+        session.lastUsed = 0
+        manager.checkIdle()
+        self.assertEqual(manager.counts(manager.checkFailures), {port: 1})
+        self.assertEqual(manager.counts(manager.reconnects), {port: 1})
+        self.assertTrue(manager.sessions[port].alive())
+        self.capture(manager, "2.jpg")
+
+    def testTemporaryDownloadPathIsRemoved(self):
+        manager = SessionManager(healthInterval=3600)
+        self.managers.append(manager)
+        filename = os.path.join(self.directory, "1.jpg")
+        manager.capture(port, model, filename)
+        self.assertTrue(os.path.isdir(manager.downloadPath))
+        manager.close()
+        self.assertFalse(os.path.exists(manager.downloadPath))
+        self.assertTrue(os.path.exists(filename))
+
+    def testUnknownCamera(self):
+        manager = self.manager(retries=0)
+        self.assertRaises(SessionError, manager.capture, "usb:009,009", model, os.path.join(self.directory, "1.jpg"))
+
+if __name__ == "__main__":
+    unittest.main()
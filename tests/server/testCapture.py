@@ -0,0 +1,76 @@
+"""Tests for the parallel capture of a spread (capture.CaptureEngine).
+
+The cameras are those of the stand-in gphoto2 of components/server/testData/bin,
+driven through the gphoto2 backend with a gphoto2 process per capture, as the
+server did before the camera sessions. Run the tests from the root of the
+repository with:
+
+    python -m unittest discover -s tests/server
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import time
+import unittest
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "server")
+sys.path.insert(0, serverPath)
+
+from cameras import CaptureError, Gphoto2Backend
+from capture import CaptureEngine
+
+stubPath = os.path.join(serverPath, "testData", "bin")
+cameras = [{"model": "Canon Powershot SX110IS", "port": "usb:002,012"},
+           {"model": "Nikon D80", "port": "usb:003,004"}]
+delay = 1.0
+
+def imageName(port):
+    return "%s.jpg" % port.replace(":", "_").replace(",", "_")
+
+class CaptureEngineTest(unittest.TestCase):
+
+    def setUp(self):
+        self.environ = dict(os.environ)
+        os.environ["PATH"] = stubPath + os.pathsep + os.environ.get("PATH", "")
+        os.environ["FAKE_GPHOTO2_DELAY"] = str(delay)
+        os.environ.pop("FAKE_GPHOTO2_CONNECT_DELAY", None)
+        self.directory = tempfile.mkdtemp()
+        self.backend = Gphoto2Backend(sessions=False)
+        self.engine = CaptureEngine(self.capture)
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.directory, True)
+
+    def capture(self, port, model):
+        filename = os.path.join(self.directory, imageName(port))
+        self.backend.capture(port, model, filename)
+        return filename
+
+    def testCamerasFireTogether(self):
+        start = time.time()
+        self.engine.capture(cameras)
+        seconds = time.time() - start
+        # One after the other, the cameras would take two delays.
+        self.assertTrue(seconds >= delay, "A spread took %.2f seconds" % seconds)
+        self.assertTrue(seconds < 1.6 * delay, "A spread took %.2f seconds" % seconds)
+
+    def testResultsInCameraOrder(self):
+        for order in (cameras, list(reversed(cameras))):
+            paths = self.engine.capture(order)
+            self.assertEqual([os.path.basename(path) for path in paths],
+                             [imageName(camera["port"]) for camera in order])
+            for path in paths:
+                self.assertTrue(os.path.getsize(path) > 0)
+
+    def testErrorOfOneCameraIsRaised(self):
+        unplugged = {"model": "Nikon D80", "port": "usb:009,009"}
+        self.assertRaises(CaptureError, self.engine.capture, [cameras[0], unplugged])
+        # The other camera still captured its image.
+        self.assertTrue(os.path.exists(os.path.join(self.directory, imageName(cameras[0]["port"]))))
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+"""Tests for the persistent image catalogue (catalogue.Catalogue).
+
+Run the tests from the root of the repository with:
+
+    python -m unittest discover -s tests/server
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "server")
+sys.path.insert(0, serverPath)
+
+from catalogue import Catalogue, PatchError, VersionConflict
+
+class CatalogueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, "catalogue.sqlite")
+        self.catalogues = []
+        self.catalogue = self.open()
+        self.ids = [self.catalogue.append({"spread": "%d.png" % i}) for i in range(3)]
+
+    def tearDown(self):
+        for catalogue in self.catalogues:
+            catalogue.close()
+        shutil.rmtree(self.directory, True)
+
+    def open(self):
+        catalogue = Catalogue(self.path)
+        self.catalogues.append(catalogue)
+        return catalogue
+
+    def spreads(self, catalogue=None):
+        return [entry["spread"] for entry in (catalogue or self.catalogue).list()]
+
+    def assertUnchanged(self, version):
+        self.assertEqual(self.catalogue.version, version)
+        self.assertEqual(self.spreads(), ["0.png", "1.png", "2.png"])
+        # Nothing reached the database either.
+        reopened = self.open()
+        self.assertEqual(reopened.version, version)
+        self.assertEqual(self.spreads(reopened), ["0.png", "1.png", "2.png"])
+
+    def testEntriesSurviveReopening(self):
+        self.catalogue.move(self.ids[2], 0)
+        reopened = self.open()
+        self.assertEqual(self.spreads(reopened), ["2.png", "0.png", "1.png"])
+        self.assertEqual(reopened.version, self.catalogue.version)
+        self.assertEqual([entry["id"] for entry in reopened.list()], [self.ids[2], self.ids[0], self.ids[1]])
+
+    def testRemoveMissingEntryChangesNothing(self):
+        version = self.catalogue.version
+        self.catalogue.remove(self.ids[0])
+        self.assertRaises(KeyError, self.catalogue.remove, self.ids[0])
+        self.assertEqual(self.catalogue.version, version + 1)
+        self.assertEqual(self.spreads(), ["1.png", "2.png"])
+
+    def testMoveOnlyTakesTheMidpoint(self):
+        positions = dict(self.catalogue.positions)
+        self.catalogue.move(self.ids[2], 1)
+        self.assertEqual(self.catalogue.positions[self.ids[2]], (positions[self.ids[0]] + positions[self.ids[1]]) / 2)
+        self.assertEqual(self.catalogue.positions[self.ids[0]], positions[self.ids[0]])
+        self.assertEqual(self.catalogue.positions[self.ids[1]], positions[self.ids[1]])
+
+    def testRenumberWhenThereIsNoRoomLeft(self):
+        # Every move to index 1 halves the gap after the first page, until
+        # the book has to be renumbered.
+        expected = self.spreads()
+        for i in range(60):
+            self.catalogue.move(self.catalogue.list()[-1]["id"], 1)
+            expected.insert(1, expected.pop())
+        self.assertEqual(self.spreads(), expected)
+        positions = [self.catalogue.positions[id] for id in self.catalogue.order]
+        # Without renumbering, 60 halvings would leave a gap of 1024 / 2 ** 60;
+        # with it, no gap gets under half of the 1e-6 the book is renumbered at.
+        gaps = [after - before for before, after in zip(positions, positions[1:])]
+        self.assertTrue(min(gaps) >= 5e-7)
+        self.assertEqual(self.spreads(self.open()), expected)
+
+    def testPatchIsAllOrNothing(self):
+        version = self.catalogue.version
+        operations = [{"op": "move", "id": self.ids[2], "index": 0},
+                      {"op": "insert", "entry": {"spread": "3.png"}},
+                      {"op": "remove", "id": 12345}]
+        self.assertRaises(PatchError, self.catalogue.patch, operations)
+        self.assertUnchanged(version)
+
+    def testPatchVersionConflict(self):
+        version = self.catalogue.version
+        self.assertRaises(VersionConflict, self.catalogue.patch, [{"op": "remove", "id": self.ids[0]}], version - 1)
+        self.assertUnchanged(version)
+
+    def testPatchIsOneChange(self):
+        version = self.catalogue.version
+        inserted = self.catalogue.patch([{"op": "remove", "id": self.ids[0]},
+                                         {"op": "insert", "index": 0, "entry": {"spread": "3.png"}}], version)
+        self.assertEqual(self.catalogue.version, version + 1)
+        self.assertEqual(self.spreads(), ["3.png", "1.png", "2.png"])
+        self.assertEqual(self.catalogue.list()[0]["id"], inserted[0])
+
+    def testReplaceKeepsIdsAndRemovesMissingEntries(self):
+        entries = self.catalogue.list()
+        entries[1]["spread"] = "1b.png"
+        self.catalogue.replace([entries[2], {"spread": "3.png"}, entries[1]])
+        listed = self.catalogue.list()
+        self.assertEqual([entry["spread"] for entry in listed], ["2.png", "3.png", "1b.png"])
+        self.assertEqual(listed[0]["id"], self.ids[2])
+        self.assertEqual(listed[2]["id"], self.ids[1])
+        self.assertFalse(self.ids[0] in self.catalogue)
+        self.assertEqual(self.spreads(self.open()), ["2.png", "3.png", "1b.png"])
+
+    def testReplaceRejectsDuplicateIds(self):
+        version = self.catalogue.version
+        entries = self.catalogue.list()
+        self.assertRaises(PatchError, self.catalogue.replace, [entries[0], entries[1], entries[0]])
+        self.assertUnchanged(version)
+        self.assertEqual(self.catalogue.order, self.ids)
+
+    def testReplaceRollsBackOnFailure(self):
+        version = self.catalogue.version
+        entries = self.catalogue.list()
+        # An entry which can not be stored fails after others were written.
+        self.assertRaises(TypeError, self.catalogue.replace, [entries[1], {"spread": object()}])
+        self.assertUnchanged(version)
+
+if __name__ == "__main__":
+    unittest.main()
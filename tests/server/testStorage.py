@@ -0,0 +1,93 @@
+"""Tests for the content-addressed image store and the retention policy
+(storage.ContentStore and storage.RetentionPolicy).
+
+Run the tests from the root of the repository with:
+
+    python -m unittest discover -s tests/server
+"""
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+serverPath = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "components", "server")
+sys.path.insert(0, serverPath)
+
+from PIL import Image
+
+from storage import ContentStore, RetentionPolicy
+
+class StorageTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.store = ContentStore(os.path.join(self.directory, "store"))
+        os.makedirs(self.store.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory, True)
+
+    def image(self, name, size, color=128):
+        """Writes an image outside the store and returns its path."""
+        path = os.path.join(self.directory, name)
+        Image.new("L", size, color).save(path)
+        return path
+
+    def put(self, contents):
+        path = os.path.join(self.directory, "new.jpg")
+        file = open(path, "wb")
+        try:
+            file.write(contents)
+        finally:
+            file.close()
+        return self.store.put(path)
+
+    def testIdenticalFilesAreStoredOnce(self):
+        first = self.put("page")
+        second = self.put("page")
+        self.assertEqual(first, second)
+        self.assertEqual(len(list(self.store.files())), 1)
+
+    def testReleaseKeepsReferencedFiles(self):
+        kept = self.put("kept")
+        released = self.put("released")
+        outside = self.image("outside.png", (10, 10))
+        freed = self.store.release([kept, released, released, outside, None], set([kept]))
+        self.assertEqual(freed, len("released"))
+        self.assertTrue(os.path.exists(kept))
+        self.assertFalse(os.path.exists(released))
+        # Only files of the store are ever removed.
+        self.assertTrue(os.path.exists(outside))
+
+    def spread(self, left, right, spread):
+        return {"left": self.image("left.png", left), "right": self.image("right.png", right),
+                "spread": self.image("spread.png", spread)}
+
+    def testVerifyCompleteSpread(self):
+        self.assertTrue(RetentionPolicy().verify(self.spread((100, 150), (100, 150), (200, 150))))
+
+    def testVerifySpreadHoldingOnePage(self):
+        self.assertFalse(RetentionPolicy().verify(self.spread((100, 150), (100, 150), (100, 150))))
+        self.assertFalse(RetentionPolicy().verify(self.spread((100, 150), (100, 160), (200, 150))))
+
+    def testVerifyBrokenSpread(self):
+        entry = self.spread((100, 150), (100, 150), (200, 150))
+        file = open(entry["spread"], "wb")
+        try:
+            file.write("not an image")
+        finally:
+            file.close()
+        self.assertFalse(RetentionPolicy().verify(entry))
+        os.unlink(entry["left"])
+        self.assertFalse(RetentionPolicy().verify(entry))
+
+    def testRawHalvesOfOnePageSpreadAreKept(self):
+        policy = RetentionPolicy(dropRawAfter=0)
+        self.assertEqual(policy.apply(self.spread((100, 150), (100, 150), (100, 150)), self.store), None)
+        entry = self.spread((100, 150), (100, 150), (200, 150))
+        self.assertEqual(policy.apply(entry, self.store), {"spread": entry["spread"]})
+
+if __name__ == "__main__":
+    unittest.main()